@@ -1,7 +1,253 @@
 import os
 import numpy as np
-import pickle
 import random
+import json
+from social_lstm.ingest import iter_annotation_blocks, write_frame_data, load_frame_data, load_homography, \
+    BLOCK_SIZE, FRAME_DATA_DTYPE
+
+
+# defaults are relative to the package, not to the working directory
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# default recording used when no data path or manifest is given
+DEFAULT_DATA_PATH = os.path.join(os.path.dirname(PACKAGE_DIR), "data", "pixel_pos.csv")
+DEFAULT_SAVE_DIR = os.path.join(PACKAGE_DIR, "save")
+DEFAULT_PLOT_DIR = os.path.join(PACKAGE_DIR, "plot")
+DEFAULT_DIMENSIONS = [640, 480]
+# frames in a block of the train/validation split, at least seq_length + 1 so every split has windows
+SPLIT_BLOCK_SIZE = 100
+
+
+def load_manifest(manifest_path):
+    '''
+    Load a recording manifest
+    params:
+    manifest_path : path of a json file holding a list of recordings, each one being
+                    {"path": ..., "dimensions": [width, height], "weight": 1.0, "name": ..., "layout": "auto",
+                     "append": [...], "homography": ..., "split_block_size": ...}
+                    only "path" is required, relative paths are relative to the manifest. "append" lists
+                    files with later frames of the same recording, see Recording.append. "homography" is
+                    the H.txt (or 3 x 3 matrix) of a recording in world coordinates, see ingest.world_to_pixel
+    '''
+    with open(manifest_path, "r") as f:
+        entries = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    recordings = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"path": entry}
+        entry = dict(entry)
+        entry["path"] = os.path.join(base_dir, entry["path"])
+        entry["append"] = [os.path.join(base_dir, path) for path in entry.get("append", [])]
+        if isinstance(entry.get("homography"), str):
+            entry["homography"] = os.path.join(base_dir, entry["homography"])
+        recordings.append(entry)
+    return recordings
+
+
+def source_key(path, layout):
+    # identifies an annotation file and how it is read
+    stat = os.stat(path)
+    return {"source": os.path.abspath(path),
+            "source_size": stat.st_size,
+            "source_mtime": stat.st_mtime,
+            "layout": layout}
+
+
+class Recording:
+    '''
+    One camera recording. It is preprocessed and cached on its own in cache_dir/name/max_num_peds_<N>/,
+    so adding a recording never touches the cache of the others, and loaders with another max_num_peds
+    (sweeps, autotune trials) keep their own copy instead of rewriting the same files.
+
+    Frames are split into blocks of split_block_size frames and every 1/validate_fraction-th block is
+    used for validation, so the split of existing frames never changes when frames are appended.
+    split_block_size defaults to SPLIT_BLOCK_SIZE, or seq_length + 1 for longer sequences, and can't be
+    smaller than that since a window never crosses into another block of the other split.
+    A window is the start frame of seq_length + 1 consecutive frames of the same split.
+    '''
+
+    def __init__(self, path, dimensions, max_num_peds, seq_length, validate_fraction, infer, name=None,
+                 cache_dir=None, layout="auto", chunk_size=BLOCK_SIZE, split_block_size=None,
+                 homography=None):
+        self.path = path
+        # "wide" 4 row layout, "long" frame,ped,x,y layout, "obsmat" world coordinates or "auto",
+        # see ingest.detect_layout
+        self.layout = layout
+        # H.txt path or 3 x 3 world to image matrix of the camera, for world coordinates
+        self.homography = homography
+        # annotations read at once while preprocessing
+        self.chunk_size = chunk_size
+        self.dimensions = list(dimensions)
+        self.max_num_peds = max_num_peds
+        self.seq_length = seq_length
+        self.validate_fraction = validate_fraction
+        if split_block_size is None:
+            split_block_size = max(SPLIT_BLOCK_SIZE, seq_length + 1)
+        elif split_block_size < seq_length + 1:
+            raise ValueError("split_block_size {} of {} is shorter than a window of seq_length + 1 = {} frames".format(
+                split_block_size, path, seq_length + 1))
+        self.split_block_size = split_block_size
+        self.infer = infer
+        if name is None:
+            name = os.path.splitext(os.path.basename(path))[0]
+        self.name = name
+        if cache_dir is None:
+            cache_dir = os.path.dirname(path)
+        # the frame tensor is max_num_peds wide, everything else of the cache key is fixed per recording
+        self.cache_path = os.path.join(cache_dir, name, "max_num_peds_{}".format(max_num_peds))
+        self.meta_path = os.path.join(self.cache_path, "meta.json")
+        self.meta = None
+
+        # frame data is loaded lazily, see load_preprocess
+        self._frame_data = None
+        self.frame_list = None
+        self.num_peds_data = None
+
+        self.num_frames = 0
+        self.num_training_frames = 0
+        self.num_validate_frames = 0
+        # start frame of every window, in increasing order
+        self.training_windows = None
+        self.validate_windows = None
+
+        # position in training_windows and validate_windows
+        self.training_window_pointer = 0
+        self.validate_window_pointer = 0
+
+    def cache_key(self):
+        # everything the cached data depends on
+        key = source_key(self.path, self.layout)
+        key["max_num_peds"] = self.max_num_peds
+        key["dtype"] = np.dtype(FRAME_DATA_DTYPE).str
+        if self.homography is not None:
+            # world coordinates are normalized with them
+            key["homography"] = load_homography(self.homography).tolist()
+            key["dimensions"] = self.dimensions
+        return key
+
+    def iter_blocks(self, path, layout):
+        return iter_annotation_blocks(path, layout, self.chunk_size, self.homography, self.dimensions)
+
+    def prepare(self, force_pre_process=False, append_paths=()):
+        '''
+        Preprocess the recording if its cache is missing or stale, append the files of append_paths
+        that are not appended yet, then read the cache metadata
+        '''
+        meta = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+        if force_pre_process or meta is None or meta["key"] != self.cache_key():
+            meta = self.preprocess()
+        self.meta = meta
+        self.update_frames(meta["num_frames"])
+
+        for path in append_paths:
+            self.append(path)
+
+    def write_meta(self):
+        # replace meta.json at once, a crash leaves either the old or the new one
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(temp_path, self.meta_path)
+
+    def preprocess(self):
+        '''
+        Stream the annotation file into the on-disk [frame, ped, 3] tensor, see ingest.write_frame_data
+        '''
+        # meta is removed first and written last, so an interrupted preprocess is redone next time
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        num_frames = write_frame_data(
+            self.cache_path,
+            lambda: self.iter_blocks(self.path, self.layout),
+            self.max_num_peds)
+
+        self.meta = {"key": self.cache_key(),
+                     "dimensions": self.dimensions,
+                     "num_frames": num_frames,
+                     "appended": []}
+        self.write_meta()
+        return self.meta
+
+    def append(self, path, layout="auto"):
+        '''
+        Append the frames of another annotation file of this recording. They must all come after the
+        frames already there. Only the new frames are read and written, existing windows keep their
+        index and split. A file already appended is skipped
+        Returns the number of new frames
+        '''
+        key = source_key(path, layout)
+        if key in self.meta["appended"]:
+            return 0
+
+        num_frames = write_frame_data(self.cache_path,
+                                      lambda: self.iter_blocks(path, layout),
+                                      self.max_num_peds,
+                                      num_frames=self.num_frames)
+        num_new_frames = num_frames - self.num_frames
+
+        self.meta["num_frames"] = num_frames
+        self.meta["appended"].append(key)
+        self.write_meta()
+        self.update_frames(num_frames)
+        return num_new_frames
+
+    def update_frames(self, num_frames):
+        self.num_frames = num_frames
+        # the memory map has the old size
+        self._frame_data = None
+
+        frame_index = np.arange(num_frames)
+        if self.infer:
+            is_validate = np.zeros(num_frames, dtype=bool)
+        else:
+            block = frame_index // self.split_block_size
+            is_validate = (np.floor((block + 1) * self.validate_fraction) >
+                           np.floor(block * self.validate_fraction))
+        self.num_validate_frames = int(np.count_nonzero(is_validate))
+        self.num_training_frames = num_frames - self.num_validate_frames
+
+        self.training_windows = self.get_windows(~is_validate)
+        self.validate_windows = self.get_windows(is_validate)
+
+    def get_windows(self, in_split):
+        # windows whose seq_length + 1 frames are all in the split
+        window_length = self.seq_length + 1
+        count = np.r_[0, np.cumsum(in_split)]
+        starts = np.arange(max(len(in_split) - window_length + 1, 0))
+        return starts[count[starts + window_length] - count[starts] == window_length]
+
+    def load_preprocess(self):
+        # frame_data contains all frames with shape [frame, ped, 3] and 3 is ID, x, y, it is memory mapped
+        self._frame_data, self.frame_list, self.num_peds_data = load_frame_data(self.cache_path, self.num_frames,
+                                                                                self.max_num_peds)
+
+    @classmethod
+    def from_arrays(cls, name, dimensions, frame_data, training_windows, validate_windows, seq_length,
+                    num_training_frames, num_validate_frames, infer=False):
+        '''
+        A recording backed by arrays already in memory instead of its cache, see shared_data.attach
+        '''
+        recording = cls(None, dimensions, frame_data.shape[1], seq_length, None, infer, name=name, cache_dir="")
+        recording._frame_data = frame_data
+        recording.num_frames = frame_data.shape[0]
+        recording.num_training_frames = num_training_frames
+        recording.num_validate_frames = num_validate_frames
+        recording.training_windows = training_windows
+        recording.validate_windows = validate_windows
+        return recording
+
+    @property
+    def frame_data(self):
+        if self._frame_data is None:
+            self.load_preprocess()
+        return self._frame_data
+
+    def get_windows_of_split(self, validate):
+        return self.validate_windows if validate else self.training_windows
 
 
 class DataLoader:
@@ -11,7 +257,26 @@ class DataLoader:
                  seq_length,
                  max_num_peds,
                  force_pre_process=False,
-                 infer=False):
+                 infer=False,
+                 data_paths=None,
+                 dimensions=None,
+                 weights=None,
+                 manifest=None,
+                 cache_dir=None,
+                 recordings=None,
+                 split_block_size=None):
+        '''
+        params:
+        data_paths : list of recording csv files, defaults to data/pixel_pos.csv next to the package
+        dimensions : list of [width, height] for every recording, defaults to [640, 480] each
+        weights : mixing weight of every recording when random choosing windows, defaults to 1 each
+        manifest : json manifest of recordings (see load_manifest), used instead of data_paths
+        cache_dir : where recordings are cached, defaults to the directory of each recording
+        recordings : already prepared Recording objects used instead of data_paths or manifest,
+                     see shared_data.attach
+        split_block_size : frames in a block of the train/validation split of every recording, see Recording.
+                           A manifest entry can set its own
+        '''
         self.batch_size = batch_size
         self.seq_length = seq_length
         self.max_num_peds = max_num_peds
@@ -19,169 +284,290 @@ class DataLoader:
 
         self.validate_fraction = 0.2
 
-        original_data_path = "../data/pixel_pos.csv"
-        transformed_data_path = "../data/transformed_data.pkl"
+        if recordings is not None:
+            entries = []
+        elif manifest is not None:
+            entries = load_manifest(manifest)
+        else:
+            if data_paths is None:
+                data_paths = [DEFAULT_DATA_PATH]
+            entries = [{"path": path} for path in data_paths]
+            for index, entry in enumerate(entries):
+                if dimensions is not None:
+                    entry["dimensions"] = dimensions[index]
+                if weights is not None:
+                    entry["weight"] = weights[index]
 
-        # all_frame_data contains data (except validation data) with shape [frame, ped, 3] and 3 is ID, x, y
-        self.training_frame_data = None
-        # what frames do data have
-        self.frame_list = None
-        # how many peds are in each frames
-        self.num_peds_data = None
-        # validate_frame_data has shape [frame, ped, 3] and 3 is ID, x, y
-        self.validate_frame_data = None
-        self.num_training_batch = 0
-        self.num_validate_batch = 0
+        self.recordings = []
+        self.weights = []
+        if recordings is not None:
+            # already prepared, e.g. attached from shared memory
+            self.recordings = list(recordings)
+            self.weights = [1.0] * len(self.recordings) if weights is None else [float(w) for w in weights]
+        for entry in entries:
+            recording = Recording(entry["path"],
+                                  entry.get("dimensions", DEFAULT_DIMENSIONS),
+                                  max_num_peds,
+                                  seq_length,
+                                  self.validate_fraction,
+                                  infer,
+                                  name=entry.get("name"),
+                                  cache_dir=cache_dir,
+                                  layout=entry.get("layout", "auto"),
+                                  chunk_size=entry.get("chunk_size", BLOCK_SIZE),
+                                  homography=entry.get("homography"),
+                                  split_block_size=entry.get("split_block_size", split_block_size))
+            recording.prepare(force_pre_process, entry.get("append", []))
+            self.recordings.append(recording)
+            self.weights.append(float(entry.get("weight", 1.0)))
 
-        if not os.path.exists(transformed_data_path) or force_pre_process:
-            self.preprocess(original_data_path, transformed_data_path)
+        # dimensions[d] is the [width, height] of the recording d returned with each window
+        self.dimensions = [recording.dimensions for recording in self.recordings]
 
-        self.load_preprocess(transformed_data_path)
+        self.num_training_batch = 0
+        self.num_validate_batch = 0
+        # batches of non-overlapping windows in an epoch, see next_stateful_batch
+        self.num_stateful_batch = 0
+        # batch_size x num_stateful_batch recording, start frame and continues-the-previous-window of
+        # the windows every stateful sequence walks through, see get_stateful_plan
+        self.stateful_plan = None
+        self.update_num_batches()
+        # position of every stateful sequence in its row of the plan
+        self.stateful_streams = [0] * self.batch_size
+        # recording being read when windows are not randomly chosen
+        self.training_recording_pointer = 0
+        self.validate_recording_pointer = 0
 
-        self.training_frame_pointer = 0
-        self.validate_frame_pointer = 0
         self.reset_batch_pointer(validate=False)
         self.reset_batch_pointer(validate=True)
 
-    def preprocess(self, original_data_path, transformed_data_path):
-        data = np.genfromtxt(original_data_path, delimiter=",")
-        # what frames do data have
-        frame_list = np.unique(data[0, :]).tolist()
-        num_frames = len(frame_list)
-        if self.infer:
-            validate_num_frames = 0
-        else:
-            validate_num_frames = int(num_frames * self.validate_fraction)
-        # training_frame_data contains data (except validation data) with shape [frame, ped, 3] and 3 is ID, x, y
-        training_frame_data = np.zeros(shape=[num_frames - validate_num_frames, self.max_num_peds, 3])
-        # validate_frame_data has shape [frame, ped, 3] and 3 is ID, x, y
-        validate_frame_data = np.zeros(shape=[validate_num_frames, self.max_num_peds, 3])
-        # how many peds are in each frames
-        num_peds_data = []
-        for index, frame in enumerate(frame_list):
-            this_frame_data = data[:, data[0, :] == frame]
-            peds_in_this_frame = this_frame_data[1, :].tolist()
-            num_peds_data.append(len(peds_in_this_frame))
-
-            ped_pos = []
-            for ped in peds_in_this_frame:
-                current_x = this_frame_data[3, this_frame_data[1, :] == ped][0]
-                current_y = this_frame_data[2, this_frame_data[1, :] == ped][0]
-                ped_pos.append((ped, current_x, current_y))
-
-            ped_pos = np.array(ped_pos)
-            if (index < num_frames - validate_num_frames) or self.infer:
-                training_frame_data[index, :len(peds_in_this_frame), :] = ped_pos
-            else:
-                validate_frame_data[index - (num_frames - validate_num_frames), :len(peds_in_this_frame), :] = ped_pos
+    def update_num_batches(self):
+        number_of_training = sum(recording.num_training_frames for recording in self.recordings)
+        number_of_validate = sum(recording.num_validate_frames for recording in self.recordings)
+        self.num_training_batch = int(number_of_training / self.batch_size) * 2  # because of the random choose
+        self.num_validate_batch = int(number_of_validate / self.batch_size)
+        self.stateful_plan = self.get_stateful_plan()
+        self.num_stateful_batch = self.stateful_plan[0].shape[1]
 
-        f = open(transformed_data_path, "wb")
-        pickle.dump((training_frame_data, frame_list, num_peds_data, validate_frame_data), f)
-        f.close()
+    def get_stateful_plan(self):
+        '''
+        Chain the non-overlapping windows of every contiguous run of training frames (window start, start +
+        seq_length, ...), concatenate the chains of all recordings in order and cut them into batch_size
+        consecutive segments of equal length, one per stateful sequence. The windows left over are dropped.
+        Returns the recording, start frame and whether it continues the previous window of the segment,
+        as batch_size x segment length arrays
+        '''
+        recordings, starts, continues = [], [], []
+        for d, recording in enumerate(self.recordings):
+            windows = recording.training_windows
+            if windows is None or len(windows) == 0:
+                continue
+            # windows of one run of training frames are consecutive start frames
+            runs = np.split(windows, np.nonzero(np.diff(windows) != 1)[0] + 1)
+            for run in runs:
+                chain = np.arange(run[0], run[-1] + 1, self.seq_length)
+                recordings.append(np.full(len(chain), d))
+                starts.append(chain)
+                continues.append(np.arange(len(chain)) > 0)
+        if not starts:
+            empty = np.zeros((self.batch_size, 0), dtype=np.int64)
+            return empty, empty, empty.astype(bool)
+        recordings, starts, continues = np.concatenate(recordings), np.concatenate(starts), np.concatenate(continues)
+        length = len(starts) // self.batch_size
+        shape = (self.batch_size, length)
+        continues = continues[:self.batch_size * length].reshape(shape).copy()
+        # a segment starts from zero states
+        continues[:, :1] = False
+        return (recordings[:self.batch_size * length].reshape(shape), starts[:self.batch_size * length].reshape(shape),
+                continues)
 
-    def load_preprocess(self, transformed_data_path):
-        f = open(transformed_data_path, "rb")
-        raw_data = pickle.load(f)
-        f.close()
+    def append(self, path, recording=0, layout="auto"):
+        '''
+        Append the later frames in path to a recording without preprocessing it again, see Recording.append
+        Returns the number of new frames
+        '''
+        num_new_frames = self.recordings[recording].append(path, layout)
+        self.update_num_batches()
+        return num_new_frames
 
-        self.training_frame_data = raw_data[0]
-        self.frame_list = raw_data[1]
-        self.num_peds_data = raw_data[2]
-        self.validate_frame_data = raw_data[3]
+    def get_sequence(self, frame_data, index):
+        '''
+        Build the source and target sequence starting at frame index. Peds keep the same slot
+        over the whole sequence
+        '''
+        seq_frame_data = frame_data[index:index+self.seq_length+1, :]
+        seq_source_frame_data = frame_data[index:index+self.seq_length, :]
+        seq_target_frame_data = frame_data[index+1:index+self.seq_length+1, :]
+        ped_in_sequence = np.unique(seq_frame_data[:, :, 0])
 
-        number_of_training = len(self.training_frame_data)
-        number_of_validate = len(self.validate_frame_data)
-        self.num_training_batch = int(number_of_training / self.batch_size) * 2  # because of the random choose
-        self.num_validate_batch = int(number_of_validate / self.batch_size)
+        source_data = np.zeros((self.seq_length, self.max_num_peds, 3), dtype=FRAME_DATA_DTYPE)
+        target_data = np.zeros((self.seq_length, self.max_num_peds, 3), dtype=FRAME_DATA_DTYPE)
 
-    def next_training_batch(self, random_choose=True):
+        for seq in range(self.seq_length):
+            this_seq_source_frame_data = seq_source_frame_data[seq, :]
+            this_seq_target_frame_data = seq_target_frame_data[seq, :]
+            for index, ped_id in enumerate(ped_in_sequence):
+                if ped_id == 0:
+                    continue
+                else:
+                    source_temp = this_seq_source_frame_data[this_seq_source_frame_data[:, 0] == ped_id, :]
+                    target_temp = this_seq_target_frame_data[this_seq_target_frame_data[:, 0] == ped_id, :]
+                    if source_temp.size != 0:
+                        source_data[seq, index, :] = source_temp
+                    if target_temp.size != 0:
+                        target_data[seq, index, :] = target_temp
+
+        return source_data, target_data
+
+    def choose_recording(self, validate, random_choose):
+        candidates = [d for d, recording in enumerate(self.recordings)
+                      if len(recording.get_windows_of_split(validate)) > 0]
+        if len(candidates) == 0:
+            raise ValueError("no recording has seq_length + 1 consecutive {} frames".format(
+                "validation" if validate else "training"))
+
+        if random_choose:
+            return random.choices(candidates, weights=[self.weights[d] for d in candidates])[0]
+
+        # go through the recordings one after another
+        pointer = self.validate_recording_pointer if validate else self.training_recording_pointer
+        while pointer not in candidates:
+            pointer = (pointer + 1) % len(self.recordings)
+        if validate:
+            self.validate_recording_pointer = pointer
+        else:
+            self.training_recording_pointer = pointer
+        return pointer
+
+    def next_batch(self, validate, random_choose=True):
         x_batch = []
         y_batch = []
+        d_batch = []
         i = 0
         while i < self.batch_size:
-            index = self.training_frame_pointer
-            if index + self.seq_length + 1 < self.training_frame_data.shape[0]:
-                seq_frame_data = self.training_frame_data[index:index+self.seq_length+1, :]
-                seq_source_frame_data = self.training_frame_data[index:index+self.seq_length, :]
-                seq_target_frame_data = self.training_frame_data[index+1:index+self.seq_length+1, :]
-                ped_in_sequence = np.unique(seq_frame_data[:, :, 0])
-
-                source_data = np.zeros((self.seq_length, self.max_num_peds, 3))
-                target_data = np.zeros((self.seq_length, self.max_num_peds, 3))
-
-                for seq in range(self.seq_length):
-                    this_seq_source_frame_data = seq_source_frame_data[seq, :]
-                    this_seq_target_frame_data = seq_target_frame_data[seq, :]
-                    for index, ped_id in enumerate(ped_in_sequence):
-                        if ped_id == 0:
-                            continue
-                        else:
-                            source_temp = this_seq_source_frame_data[this_seq_source_frame_data[:, 0] == ped_id, :]
-                            target_temp = this_seq_target_frame_data[this_seq_target_frame_data[:, 0] == ped_id, :]
-                            if source_temp.size != 0:
-                                source_data[seq, index, :] = source_temp
-                            if target_temp.size != 0:
-                                target_data[seq, index, :] = target_temp
+            d = self.choose_recording(validate, random_choose)
+            recording = self.recordings[d]
+            windows = recording.get_windows_of_split(validate)
+            if validate:
+                pointer = recording.validate_window_pointer
+            else:
+                pointer = recording.training_window_pointer
+
+            if pointer < len(windows):
+                source_data, target_data = self.get_sequence(recording.frame_data, windows[pointer])
 
                 x_batch.append(source_data)
                 y_batch.append(target_data)
+                d_batch.append(d)
 
                 if random_choose:
-                    self.training_frame_pointer += random.randint(1, self.seq_length)
+                    step = random.randint(1, self.seq_length)
+                else:
+                    step = self.seq_length
+                if validate:
+                    recording.validate_window_pointer += step
                 else:
-                    self.training_frame_pointer += self.seq_length
+                    recording.training_window_pointer += step
 
                 i += 1
             else:
-                self.training_frame_pointer = 0
+                if validate:
+                    recording.validate_window_pointer = 0
+                    if not random_choose:
+                        self.validate_recording_pointer = (d + 1) % len(self.recordings)
+                else:
+                    recording.training_window_pointer = 0
+                    if not random_choose:
+                        self.training_recording_pointer = (d + 1) % len(self.recordings)
 
-        return x_batch, y_batch
+        return x_batch, y_batch, d_batch
 
-    def next_validate_batch(self, random_choose=True):
+    def next_stateful_batch(self):
+        '''
+        Training windows for truncated backpropagation through time: sequence b walks its own consecutive
+        segment of the training frames in order (see get_stateful_plan), so within a run of training frames
+        its window is the one right after its window of the previous batch (its first source frame follows
+        the last source frame of the previous one) and the LSTM states can be carried over. After
+        num_stateful_batch batches every training window of the plan was seen once, then the segments start over.
+        Returns x_batch, y_batch, d_batch, ped_ids_batch and reset_batch. ped_ids_batch[b] holds the ped id
+        of every slot of sequence b (0 for empty slots) and reset_batch[b] is True when sequence b does not
+        continue the previous one
+        '''
         x_batch = []
         y_batch = []
-        i = 0
-        while i < self.batch_size:
-            index = self.validate_frame_pointer
-            if index + self.seq_length + 1 < self.validate_frame_data.shape[0]:
-                seq_frame_data = self.validate_frame_data[index:index+self.seq_length+1, :]
-                seq_source_frame_data = self.validate_frame_data[index:index+self.seq_length, :]
-                seq_target_frame_data = self.validate_frame_data[index+1:index+self.seq_length+1, :]
-                ped_in_sequence = np.unique(seq_frame_data[:, :, 0])
-
-                source_data = np.zeros((self.seq_length, self.max_num_peds, 3))
-                target_data = np.zeros((self.seq_length, self.max_num_peds, 3))
-
-                for seq in range(self.seq_length):
-                    this_seq_source_frame_data = seq_source_frame_data[seq, :]
-                    this_seq_target_frame_data = seq_target_frame_data[seq, :]
-                    for index, ped_id in enumerate(ped_in_sequence):
-                        if ped_id == 0:
-                            continue
-                        else:
-                            source_temp = this_seq_source_frame_data[this_seq_source_frame_data[:, 0] == ped_id, :]
-                            target_temp = this_seq_target_frame_data[this_seq_target_frame_data[:, 0] == ped_id, :]
-                            if source_temp.size != 0:
-                                source_data[seq, index, :] = source_temp
-                            if target_temp.size != 0:
-                                target_data[seq, index, :] = target_temp
+        d_batch = []
+        ped_ids_batch = []
+        reset_batch = []
+        if self.num_stateful_batch == 0:
+            raise ValueError("fewer than batch_size={} non-overlapping training windows".format(self.batch_size))
+        plan_recordings, plan_starts, plan_continues = self.stateful_plan
+        for b in range(self.batch_size):
+            position = self.stateful_streams[b] % self.num_stateful_batch
+            d, start = int(plan_recordings[b, position]), int(plan_starts[b, position])
+            reset = not plan_continues[b, position]
+            self.stateful_streams[b] = position + 1
 
-                x_batch.append(source_data)
-                y_batch.append(target_data)
+            frame_data = self.recordings[d].frame_data
+            source_data, target_data = self.get_sequence(frame_data, start)
+            # same slots as get_sequence
+            ped_in_sequence = np.unique(frame_data[start:start+self.seq_length+1, :, 0])
+            ped_ids = np.zeros(self.max_num_peds, dtype=FRAME_DATA_DTYPE)
+            ped_ids[:len(ped_in_sequence)] = ped_in_sequence
 
-                if random_choose:
-                    self.validate_frame_pointer += random.randint(1, self.seq_length)
-                else:
-                    self.validate_frame_pointer += self.seq_length
+            x_batch.append(source_data)
+            y_batch.append(target_data)
+            d_batch.append(d)
+            ped_ids_batch.append(ped_ids)
+            reset_batch.append(reset)
 
-                i += 1
-            else:
-                self.validate_frame_pointer = 0
+        return x_batch, y_batch, d_batch, ped_ids_batch, reset_batch
+
+    def reset_stateful_streams(self):
+        self.stateful_streams = [0] * self.batch_size
+
+    def get_state(self):
+        '''
+        Position of the loader, everything next_batch and next_stateful_batch read besides the random module
+        '''
+        return {"recordings": [recording.name for recording in self.recordings],
+                "training_window_pointers": [recording.training_window_pointer for recording in self.recordings],
+                "validate_window_pointers": [recording.validate_window_pointer for recording in self.recordings],
+                "training_recording_pointer": self.training_recording_pointer,
+                "validate_recording_pointer": self.validate_recording_pointer,
+                "stateful_streams": list(self.stateful_streams)}
 
-        return x_batch, y_batch
+    def set_state(self, state):
+        '''
+        Continue from a position of get_state, the recordings must be the same
+        '''
+        names = [recording.name for recording in self.recordings]
+        if state["recordings"] != names:
+            raise ValueError("loader state of recordings {} can't be restored on {}".format(state["recordings"], names))
+        for recording, training, validate in zip(self.recordings, state["training_window_pointers"],
+                                                 state["validate_window_pointers"]):
+            recording.training_window_pointer = training
+            recording.validate_window_pointer = validate
+        self.training_recording_pointer = state["training_recording_pointer"]
+        self.validate_recording_pointer = state["validate_recording_pointer"]
+        self.stateful_streams = list(state["stateful_streams"])
+
+    def next_training_batch(self, random_choose=True):
+        '''
+        Returns x_batch, y_batch, d_batch. x and y are lists of seq_length x max_num_peds x 3 arrays and
+        d holds the recording index of every sequence, see self.dimensions
+        '''
+        return self.next_batch(validate=False, random_choose=random_choose)
+
+    def next_validate_batch(self, random_choose=True):
+        return self.next_batch(validate=True, random_choose=random_choose)
 
     def reset_batch_pointer(self, validate):
+        for recording in self.recordings:
+            if validate:
+                recording.validate_window_pointer = 0
+            else:
+                recording.training_window_pointer = 0
         if validate:
-            self.validate_frame_pointer = 0
+            self.validate_recording_pointer = 0
         else:
-            self.training_frame_pointer = 0
+            self.training_recording_pointer = 0
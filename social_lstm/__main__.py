@@ -0,0 +1,52 @@
+import sys
+import time
+import argparse
+import importlib
+
+
+# subcommand -> (module whose main() runs it, help). Modules are imported only when their subcommand runs,
+# and import tensorflow or matplotlib only once they need them, so --help and data-only commands start fast
+SUBCOMMANDS = {
+    "preprocess": ("social_lstm.ingest", "preprocess an annotation file into the recording cache"),
+    "train": ("social_lstm.train", "train a model"),
+    "evaluate": ("social_lstm.social_sample", "sample the validation windows and report the mean error"),
+    "visualize": ("social_lstm.social_visualize", "plot the results of evaluate"),
+    "export": ("social_lstm.export", "export a checkpoint to a frozen inference graph"),
+    "export_weights": ("social_lstm.numpy_model", "export a checkpoint to the weights of the numpy engine"),
+    "bench": ("social_lstm.benchmark", "latency of the inference paths"),
+    "serve": ("social_lstm.server", "prediction server on top of the numpy engine"),
+    "sweep": ("social_lstm.sweep", "hyperparameter sweep"),
+    "autotune": ("social_lstm.autotune", "pick the batch size, threads and workers for this machine"),
+}
+
+
+def main(argv=None):
+    start = time.perf_counter()
+    parser = argparse.ArgumentParser(prog="social_lstm",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="commands:\n" + "\n".join("  {:<16}{}".format(name, SUBCOMMANDS[name][1])
+                                                                       for name in SUBCOMMANDS) +
+                                     "\n\npython -m social_lstm <command> --help for the arguments of a command")
+    parser.add_argument("--timing", action="store_true",
+                        help="print the import and run time of the command")
+    parser.add_argument("command", choices=list(SUBCOMMANDS), metavar="command",
+                        help="one of the commands below")
+    parser.add_argument("arguments", nargs=argparse.REMAINDER,
+                        help="arguments of the command")
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module(SUBCOMMANDS[args.command][0])
+    imported = time.perf_counter()
+    # the command parses its own arguments, its usage shows as "social_lstm <command>"
+    sys.argv = ["social_lstm " + args.command] + args.arguments
+    try:
+        module.main()
+    finally:
+        if args.timing:
+            end = time.perf_counter()
+            print("{}: import {:.3f}s, run {:.3f}s".format(args.command, imported - start, end - imported),
+                  file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
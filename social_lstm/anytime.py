@@ -0,0 +1,163 @@
+import time
+import numpy as np
+
+
+def roi_distance(positions, roi):
+    '''
+    Distance of N x 2 positions to a region of interest, either a point (x, y) or a box
+    (x_min, y_min, x_max, y_max), 0 inside the box
+    '''
+    roi = np.asarray(roi, dtype=np.float64)
+    if len(roi) == 2:
+        return np.linalg.norm(positions - roi, axis=1)
+    low, high = roi[:2], roi[2:]
+    return np.linalg.norm(np.maximum(np.maximum(low - positions, positions - high), 0), axis=1)
+
+
+class AnytimePredictor:
+    '''
+    Predict within a deadline on top of the numpy engine. The cost of one frame is modelled as a
+    fixed part plus a part per (sample x ped slot), fitted on exponential moving averages of the
+    measured frames, and the prediction gives up, in this order: samples, peds far from the region
+    of interest, then predicted frames.
+    Peds are kept closest to the region of interest first, the dropped ones are also left out of
+    the social grids of the kept ones.
+    '''
+
+    def __init__(self, engine, smoothing=0.2, margin=0.9):
+        '''
+        params:
+        engine : NumpySocialLSTM, e.g. SocialLSTMModel.get_engine(sess)
+        smoothing : weight of the newest measurement in the moving average
+        margin : fraction of the time left that the plan may use
+        '''
+        self.engine = engine
+        self.smoothing = smoothing
+        self.margin = margin
+        # seconds per frame, fixed and for one sample and one ped slot, None until the first measurement
+        self.frame_cost = None
+        self.unit_cost = None
+        # moving averages of units, seconds, units**2 and units*seconds per frame, the fit is a least squares
+        # line through them
+        self.moments = None
+
+    def measure(self, seconds, frames, units):
+        '''
+        Add a measurement to the cost model
+        params:
+        seconds : time the frames took
+        frames : number of frames timed
+        units : samples x ped slots of every frame
+        '''
+        if frames <= 0:
+            return
+        cost = seconds / frames
+        moments = np.array([units, cost, units * units, units * cost], dtype=np.float64)
+        if self.moments is None:
+            self.moments = moments
+        else:
+            self.moments = (1 - self.smoothing) * self.moments + self.smoothing * moments
+        mean_units, mean_cost, mean_units2, mean_units_cost = self.moments
+        variance = mean_units2 - mean_units * mean_units
+        if variance > 1e-2 * max(mean_units * mean_units, 1):
+            self.unit_cost = max((mean_units_cost - mean_units * mean_cost) / variance, 0.0)
+        elif self.unit_cost is None:
+            # a single size seen so far, the fixed part can not be told apart yet
+            self.unit_cost = mean_cost / max(mean_units, 1)
+        # with too little spread in the sizes the last slope is kept and the fixed part follows the level
+        self.frame_cost = max(mean_cost - self.unit_cost * mean_units, 0.0)
+
+    def estimate(self, frames, num_samples, num_peds):
+        if self.unit_cost is None:
+            return 0.0
+        return frames * (self.frame_cost + num_samples * num_peds * self.unit_cost)
+
+    def plan(self, time_left, obs_frames, pred_length, num_samples, num_peds):
+        '''
+        Samples and peds of the largest prediction expected to finish the whole horizon in time_left
+        '''
+        budget = time_left * self.margin
+        for samples in range(num_samples, 0, -1):
+            # observing is done once for all samples
+            if self.estimate(obs_frames, 1, num_peds) + self.estimate(pred_length, samples, num_peds) <= budget:
+                return samples, num_peds
+        for peds in range(num_peds - 1, 0, -1):
+            if self.estimate(obs_frames, 1, peds) + self.estimate(pred_length, 1, peds) <= budget:
+                return 1, peds
+        return 1, min(num_peds, 1)
+
+    def predict(self, traj, dimensions, deadline, pred_length=6, num_samples=1, roi=None, rng=None):
+        '''
+        params:
+        traj : obs_length x MNP x 3 observed frames
+        dimensions : [width, height] of the scene
+        deadline : time.monotonic() the prediction must be done by
+        pred_length, num_samples : the prediction wanted if there is time
+        roi : point or box (see roi_distance) whose peds come first, the last observed positions are used
+        rng : numpy RandomState used for sampling
+        Returns num_samples x (obs_length + horizon) x MNP x 3 with the predicted frames of the kept peds
+        (id 0 elsewhere), and a report of what was truncated
+        '''
+        start = time.monotonic()
+        if rng is None:
+            rng = np.random
+        traj = np.asarray(traj, dtype=np.float32)
+        obs_length = traj.shape[0]
+
+        # peds of the last observed frame, closest to the region of interest first
+        slots = np.nonzero(traj[-1, :, 0])[0]
+        if roi is not None and len(slots) > 0:
+            slots = slots[np.argsort(roi_distance(traj[-1, slots, 1:3], roi), kind="stable")]
+        samples, num_peds = self.plan(deadline - start, obs_length - 1, pred_length, num_samples, len(slots))
+        kept = slots[:num_peds]
+        if len(kept) == 0:
+            # nobody to predict
+            result = np.zeros((num_samples, obs_length + pred_length) + traj.shape[1:], dtype=np.float32)
+            result[:, :obs_length] = traj
+            return result, {"horizon": pred_length, "requested_horizon": pred_length, "num_samples": num_samples,
+                            "requested_samples": num_samples, "peds": [], "dropped_peds": [], "truncated": False,
+                            "elapsed_ms": (time.monotonic() - start) * 1000, "missed_deadline": False}
+
+        # the kept peds only, in priority order
+        frames = traj[:, kept]
+        step_start = time.monotonic()
+        grids = self.engine.get_grid(frames, [dimensions] * obs_length)
+        states = self.engine.observe(frames[np.newaxis, :-1], grids[np.newaxis, :-1])
+        self.measure(time.monotonic() - step_start, obs_length - 1, len(kept))
+
+        states = np.repeat(states, samples, axis=0)
+        prev_data = np.repeat(frames[np.newaxis, -1], samples, axis=0)
+        prev_grid_data = np.repeat(grids[np.newaxis, -1], samples, axis=0)
+        predictions = []
+        # time the last frame took, in case the estimate is off
+        step_time = 0.0
+        for t in range(pred_length):
+            # stop before a frame that would not finish in time
+            if predictions and time.monotonic() + max(self.estimate(1, samples, len(kept)), step_time) > deadline:
+                break
+            step_start = time.monotonic()
+            output, states = self.engine.step(prev_data, prev_grid_data, states)
+            next_x, next_y = self.engine.sample_positions(output, rng)
+            prev_data = np.stack([prev_data[:, :, 0], next_x, next_y], axis=2).astype(np.float32)
+            predictions.append(prev_data)
+            if t != pred_length - 1:
+                prev_grid_data = self.engine.get_grid(prev_data, [dimensions] * samples)
+            step_time = time.monotonic() - step_start
+            self.measure(step_time, 1, samples * len(kept))
+
+        horizon = len(predictions)
+        result = np.zeros((samples, obs_length + horizon) + traj.shape[1:], dtype=np.float32)
+        result[:, :obs_length] = traj
+        if horizon > 0:
+            result[:, obs_length:, kept] = np.stack(predictions, axis=1)
+        end = time.monotonic()
+        report = {"horizon": horizon,
+                  "requested_horizon": pred_length,
+                  "num_samples": samples,
+                  "requested_samples": num_samples,
+                  "peds": traj[-1, kept, 0].tolist(),
+                  "dropped_peds": traj[-1, slots[num_peds:], 0].tolist(),
+                  "truncated": horizon < pred_length or samples < num_samples or num_peds < len(slots),
+                  "elapsed_ms": (end - start) * 1000,
+                  "missed_deadline": end > deadline}
+        return result, report
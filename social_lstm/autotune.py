@@ -0,0 +1,364 @@
+import os
+import csv
+import json
+import time
+import queue
+import resource
+import argparse
+import multiprocessing
+import numpy as np
+
+from social_lstm.DataLoader import DataLoader
+from social_lstm.utils import pin_threads, parse_args_with_config
+
+
+# arguments chosen by the tuner, written to the config loaded with --config
+TUNED_KEYS = ["batch_size", "max_num_peds", "intra_op_threads", "inter_op_threads", "parallel_workers",
+              "threads_per_worker"]
+# rough sizes for estimate_memory, compare them with the peak memory measured by the trials
+TENSORFLOW_BASE_BYTES = 400 * 2 ** 20
+GRAPH_BYTES_PER_CELL = 256 * 2 ** 10
+
+
+def get_num_params(args):
+    '''
+    Number of trainable parameters of SocialLSTMModel for args
+    '''
+    lstm_num, embedding_size = args.lstm_num, args.embedding_size
+    if args.pyramid:
+        tensor_size = (1 ** 2 + 2 ** 2 + 4 ** 2) * lstm_num * 2
+    else:
+        tensor_size = args.grid_size ** 2 * lstm_num * 2
+    rank = getattr(args, "embedding_rank", 0)
+    tensor_embedding = (tensor_size + embedding_size) * rank if rank > 0 else tensor_size * embedding_size
+    return (3 * embedding_size + tensor_embedding + embedding_size +
+            (2 * embedding_size + lstm_num) * 4 * lstm_num + 4 * lstm_num + lstm_num * 5 + 5)
+
+
+def estimate_memory(args):
+    '''
+    Rough peak memory in bytes of training with args: every process (the trainer and each gradient worker)
+    holds the unrolled graph, the variables with their RMSProp slots and gradients, and the activations
+    of one sequence kept for backpropagation
+    '''
+    seq_length, mnp = args.seq_length, args.max_num_peds
+    cells = seq_length * mnp
+    grid_cells = 21 if args.pyramid else args.grid_size ** 2
+    # weights, two RMSProp slots and the gradients, in float32
+    variables = get_num_params(args) * 4 * 4
+    # per cell: social tensor, embeddings, LSTM gates and states, in float32
+    activations = cells * (grid_cells * args.lstm_num * 2 + 2 * args.embedding_size + 6 * args.lstm_num) * 4
+    # masks of a sequence as fed (uint8) and cast to float32
+    grids = seq_length * mnp * (mnp if not args.pyramid else 1) * grid_cells * 5
+    # source and target frames of a batch
+    frames = args.batch_size * seq_length * mnp * 3 * 4 * 2
+    per_process = TENSORFLOW_BASE_BYTES + cells * GRAPH_BYTES_PER_CELL + variables + activations + grids
+    return (1 + getattr(args, "parallel_workers", 0)) * per_process + frames
+
+
+def get_memory_budget(fraction=0.8):
+    '''
+    fraction of the physical memory, in bytes
+    '''
+    return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * fraction)
+
+
+def get_required_max_num_peds(data_loader):
+    '''
+    Smallest max_num_peds that fits every seq_length + 1 frame window, smaller ones drop peds from sequences.
+    DataLoader.get_sequence gives a slot to every id of the window, also to the id 0 of the empty rows, so a
+    window needs one slot more than its peds unless every one of its frames holds all of them
+    '''
+    required = 0
+    length = data_loader.seq_length + 1
+    for recording in data_loader.recordings:
+        num_windows = recording.num_frames - length + 1
+        if num_windows <= 0:
+            continue
+        ped_ids = recording.frame_data[:, :, 0]
+        frames, slots = np.nonzero(ped_ids)
+        ids = ped_ids[frames, slots]
+        # every ped with its frames in order, once per frame
+        order = np.lexsort((frames, ids))
+        frames, ids = frames[order], ids[order]
+        first = np.ones(len(ids), dtype=bool)
+        first[1:] = ids[1:] != ids[:-1]
+        keep = first.copy()
+        keep[1:] |= frames[1:] != frames[:-1]
+        frames, first = frames[keep], first[keep]
+        # previous frame of the same ped, the ped counts once in the windows between it and this frame
+        previous = np.where(first, -length, np.concatenate([[0], frames[:-1]]))
+        low = np.maximum(np.maximum(previous + 1, frames - length + 1), 0)
+        high = np.minimum(frames, num_windows - 1)
+        valid = low <= high
+        # peds of every window, from the difference of the number of peds starting and ending
+        changes = (np.bincount(low[valid], minlength=num_windows + 1) -
+                   np.bincount(high[valid] + 1, minlength=num_windows + 1))
+        window_peds = np.cumsum(changes)[:num_windows]
+        # fewest peds of a frame of every window, below window_peds the frame has an empty row
+        frame_peds = np.bincount(frames, minlength=recording.num_frames)
+        fewest_peds = np.lib.stride_tricks.sliding_window_view(frame_peds, length).min(axis=1)
+        required = max(required, int(np.max(window_peds + (fewest_peds < window_peds))))
+    return required
+
+
+def check_max_num_peds(args, max_num_peds):
+    '''
+    Build every training and validation sequence of args with max_num_peds, returns the number of windows
+    that do not fit
+    '''
+    data_loader = DataLoader(args.batch_size, args.seq_length, max_num_peds, infer=False, manifest=args.manifest)
+    failed = 0
+    for recording in data_loader.recordings:
+        for windows in (recording.training_windows, recording.validate_windows):
+            for start in windows if windows is not None else []:
+                try:
+                    data_loader.get_sequence(recording.frame_data, start)
+                except IndexError:
+                    failed += 1
+    return failed
+
+
+def run_trial(args, num_batches, warmup, results):
+    '''
+    Body of one trial process: time num_batches real training batches and a sampling rollout with args
+    '''
+    # pin the thread pools before tensorflow is imported in this process
+    if args.intra_op_threads > 0:
+        pin_threads(args.intra_op_threads)
+    try:
+        import tensorflow as tf
+        from social_lstm.model import SocialLSTMModel
+        from social_lstm.train import get_feed
+        from social_lstm.parallel_train import GradientWorkers
+        from social_lstm.numpy_model import NumpySocialLSTM, CONFIG_KEYS, init_weights
+
+        data_loader = DataLoader(args.batch_size, args.seq_length, args.max_num_peds, infer=False,
+                                 manifest=args.manifest)
+        config = tf.ConfigProto(intra_op_parallelism_threads=args.intra_op_threads,
+                                inter_op_parallelism_threads=args.inter_op_threads)
+        graph = tf.Graph()
+        with graph.as_default(), tf.Session(graph=graph, config=config) as sess:
+            start = time.perf_counter()
+            model = SocialLSTMModel(args, pyramid=bool(args.pyramid))
+            sess.run(tf.global_variables_initializer())
+            workers = None
+            if args.parallel_workers > 0:
+                workers = GradientWorkers(args, data_loader, tf.trainable_variables(), args.parallel_workers)
+            build_seconds = time.perf_counter() - start
+
+            def train_batch():
+                if workers is not None:
+                    workers.step(sess, model)
+                    return
+                x, y, d = data_loader.next_training_batch()
+                for batch in range(data_loader.batch_size):
+                    sess.run(model.train_op, get_feed(model, args, data_loader, x[batch], y[batch], d[batch]))
+
+            for _ in range(warmup):
+                train_batch()
+            start = time.perf_counter()
+            for _ in range(num_batches):
+                train_batch()
+            train_seconds = time.perf_counter() - start
+            if workers is not None:
+                workers.close()
+
+        # the sampling rollout of social_sample.py, on a batch of validation windows
+        engine_config = {key: int(getattr(args, key, 0)) for key in CONFIG_KEYS}
+        engine = NumpySocialLSTM(init_weights(engine_config), engine_config)
+        x, _, d = data_loader.next_validate_batch()
+        scenes = np.stack(x)
+        dimensions = [data_loader.dimensions[index] for index in d]
+        obs_length = args.seq_length // 2
+        grids = np.stack([engine.get_grid(scene, [dimension] * obs_length)
+                          for scene, dimension in zip(scenes[:, :obs_length], dimensions)])
+        start = time.perf_counter()
+        engine.sample_batch(scenes[:, :obs_length], grids, dimensions, args.seq_length - obs_length)
+        rollout_seconds = time.perf_counter() - start
+
+        # kilobytes on linux, the workers count as much as the largest one
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        peak += args.parallel_workers * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        results.put(("done", {"sequences_per_s": num_batches * args.batch_size / train_seconds,
+                              "rollout_scenes_per_s": len(scenes) / rollout_seconds,
+                              "build_s": build_seconds,
+                              "peak_memory_mb": peak / 2 ** 20}))
+    except Exception as e:
+        results.put(("failed", repr(e)))
+        raise
+
+
+class Autotuner:
+    '''
+    Pick batch_size, max_num_peds, the tensorflow thread pools and the number of gradient workers with the
+    best training throughput on this machine within a memory budget. Every trial runs the real training step
+    in a new process (tensorflow sizes its thread pools once per process) for a few batches, trials whose
+    estimated or measured memory is over the budget are rejected. The search is staged: the thread pools and
+    workers are tuned for each max_num_peds, then the batch size for the best of them
+    '''
+
+    def __init__(self, args, memory_budget, num_batches=3, warmup=1, timeout=600):
+        '''
+        params:
+        args : train.py arguments the trials start from
+        memory_budget : bytes the training may use
+        num_batches, warmup : timed and untimed batches of every trial
+        timeout : seconds a trial may take
+        '''
+        self.args = args
+        self.memory_budget = memory_budget
+        self.num_batches = num_batches
+        self.warmup = warmup
+        self.timeout = timeout
+        # (trial arguments, result or None, reason it was rejected or None)
+        self.trials = []
+
+    def make_args(self, **values):
+        trial_args = argparse.Namespace(**vars(self.args))
+        for key, value in values.items():
+            setattr(trial_args, key, value)
+        return trial_args
+
+    def run(self, trial_args):
+        '''
+        Result of one trial, None if it was rejected
+        '''
+        values = {key: getattr(trial_args, key) for key in TUNED_KEYS}
+        estimate = estimate_memory(trial_args)
+        if estimate > self.memory_budget:
+            return self.reject(values, "estimated {:.0f} MB".format(estimate / 2 ** 20))
+
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        process = context.Process(target=run_trial, args=(trial_args, self.num_batches, self.warmup, results),
+                                  daemon=True)
+        process.start()
+        try:
+            kind, result = results.get(timeout=self.timeout)
+        except queue.Empty:
+            process.terminate()
+            kind, result = "failed", "timeout or the process was killed (out of memory?)"
+        process.join()
+        if kind == "failed":
+            return self.reject(values, result)
+
+        result["estimated_memory_mb"] = estimate / 2 ** 20
+        if result["peak_memory_mb"] * 2 ** 20 > self.memory_budget:
+            return self.reject(values, "measured {:.0f} MB".format(result["peak_memory_mb"]), result)
+        self.trials.append((values, result, None))
+        print("{} : {:.1f} sequences/s, rollout {:.1f} scenes/s, peak {:.0f} MB (estimated {:.0f} MB)".format(
+            values, result["sequences_per_s"], result["rollout_scenes_per_s"], result["peak_memory_mb"],
+            result["estimated_memory_mb"]))
+        return result
+
+    def reject(self, values, reason, result=None):
+        self.trials.append((values, result, reason))
+        print("{} : rejected, {}".format(values, reason))
+        return None
+
+    def tune(self, batch_sizes, max_num_peds, intra_op_threads, inter_op_threads, parallel_workers):
+        '''
+        Returns the best values of TUNED_KEYS and their result
+        '''
+        cores = os.cpu_count() or 1
+        best = (None, None)
+
+        def consider(trial_args):
+            nonlocal best
+            result = self.run(trial_args)
+            if result is not None and (best[1] is None or result["sequences_per_s"] > best[1]["sequences_per_s"]):
+                best = ({key: getattr(trial_args, key) for key in TUNED_KEYS}, result)
+
+        for mnp in max_num_peds:
+            for intra in intra_op_threads:
+                for inter in inter_op_threads:
+                    consider(self.make_args(max_num_peds=mnp, intra_op_threads=intra, inter_op_threads=inter,
+                                            parallel_workers=0))
+            for workers in parallel_workers:
+                if 1 < workers <= min(cores, self.args.batch_size):
+                    # the workers share the cores, the coordinator only averages
+                    consider(self.make_args(max_num_peds=mnp, intra_op_threads=1, inter_op_threads=1,
+                                            parallel_workers=workers, threads_per_worker=max(cores // workers, 1)))
+        if best[0] is None:
+            return best
+
+        for batch_size in batch_sizes:
+            if batch_size != best[0]["batch_size"] and batch_size >= best[0]["parallel_workers"]:
+                consider(self.make_args(**dict(best[0], batch_size=batch_size)))
+        return best
+
+    def write_trials(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(TUNED_KEYS + ["sequences_per_s", "rollout_scenes_per_s", "peak_memory_mb",
+                                          "estimated_memory_mb", "rejected"])
+            for values, result, reason in self.trials:
+                result = result or {}
+                writer.writerow([values[key] for key in TUNED_KEYS] +
+                                [result.get(key, "") for key in ("sequences_per_s", "rollout_scenes_per_s",
+                                                                 "peak_memory_mb", "estimated_memory_mb")] +
+                                [reason or ""])
+
+
+def main():
+    from social_lstm.train import get_parser
+
+    parser = get_parser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[8, 16, 32],
+                        help="batch sizes to try")
+    parser.add_argument("--max_num_peds_candidates", type=int, nargs="*", default=None,
+                        help="max_num_peds to try, the ones below the peds of the largest window are skipped "
+                             "(default: --max_num_peds only)")
+    parser.add_argument("--intra_op_candidates", type=int, nargs="+", default=None,
+                        help="intra op threads to try (default: 1, half and all the cores)")
+    parser.add_argument("--inter_op_candidates", type=int, nargs="+", default=[1, 2],
+                        help="inter op threads to try")
+    parser.add_argument("--worker_candidates", type=int, nargs="*", default=[2, 4],
+                        help="numbers of gradient workers to try, see train.py --parallel_workers")
+    parser.add_argument("--memory_mb", type=float, default=None,
+                        help="memory budget (default: 80%% of the physical memory)")
+    parser.add_argument("--trial_batches", type=int, default=3,
+                        help="timed batches of every trial")
+    parser.add_argument("--check_required", action="store_true",
+                        help="build every window with the smallest max_num_peds that fits them and exit")
+    parser.add_argument("--output", type=str, default="autotune.json",
+                        help="config to write, load it with train.py --config or social_sample.py --config")
+    args = parse_args_with_config(parser)
+    # trials only time steps, nothing of save_dir is read or written
+    args.resume = 0
+
+    cores = os.cpu_count() or 1
+    intra_op_candidates = args.intra_op_candidates or sorted({1, max(cores // 2, 1), cores})
+    max_num_peds = args.max_num_peds_candidates or [args.max_num_peds]
+    data_loader = DataLoader(args.batch_size, args.seq_length, max(max_num_peds), infer=False,
+                             manifest=args.manifest)
+    required = get_required_max_num_peds(data_loader)
+    print("the largest window needs max_num_peds {}".format(required))
+    if args.check_required:
+        failed = check_max_num_peds(args, required)
+        print("windows that do not fit in max_num_peds {}: {}".format(required, failed))
+        if failed:
+            raise SystemExit(1)
+        return
+    kept = [mnp for mnp in max_num_peds if mnp >= required]
+    if not kept:
+        kept = [max(max_num_peds)]
+        print("every max_num_peds drops peds, trying {} only".format(kept[0]))
+
+    memory_budget = args.memory_mb * 2 ** 20 if args.memory_mb is not None else get_memory_budget()
+    tuner = Autotuner(args, memory_budget, num_batches=args.trial_batches)
+    best, result = tuner.tune(args.batch_sizes, sorted(kept), intra_op_candidates, args.inter_op_candidates,
+                              args.worker_candidates)
+    tuner.write_trials(os.path.splitext(args.output)[0] + "_trials.csv")
+    if best is None:
+        print("no configuration fits in {:.0f} MB".format(memory_budget / 2 ** 20))
+        return
+
+    with open(args.output, "w") as f:
+        json.dump(best, f, indent=2)
+    print("best {} : {:.1f} sequences/s, written to {}".format(best, result["sequences_per_s"], args.output))
+
+
+if __name__ == "__main__":
+    main()
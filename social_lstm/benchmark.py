@@ -0,0 +1,299 @@
+import os
+import sys
+import time
+import pickle
+import argparse
+import subprocess
+import numpy as np
+
+from social_lstm.numpy_model import NumpySocialLSTM, init_weights, compress_weights
+from social_lstm.anytime import AnytimePredictor
+from social_lstm.utils import percentiles
+from social_lstm.grid import get_sequence_grid_mask, get_sequence_pyramid_mask
+
+
+def time_call(function, repeat, warmup=1):
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def make_scenes(batch_size, length, max_num_peds, num_peds, seed=0):
+    '''
+    Random scenes of num_peds walking peds, B x length x MNP x 3
+    '''
+    rng = np.random.RandomState(seed)
+    scenes = np.zeros((batch_size, length, max_num_peds, 3), dtype=np.float32)
+    start = rng.uniform(0.2, 0.8, size=(batch_size, 1, num_peds, 2))
+    velocity = rng.uniform(-0.01, 0.01, size=(batch_size, 1, num_peds, 2))
+    scenes[:, :, :num_peds, 0] = np.arange(1, num_peds + 1)
+    scenes[:, :, :num_peds, 1:] = start + velocity * np.arange(length)[np.newaxis, :, np.newaxis, np.newaxis]
+    return scenes
+
+
+def print_result(name, result):
+    print("{:<40} mean {mean:8.2f} ms  p50 {p50:8.2f} ms  p90 {p90:8.2f} ms  p99 {p99:8.2f} ms".format(name, **result))
+
+
+def bench_numpy_engine(weights_path, config, batch_sizes, obs_length, pred_length, num_peds, repeat):
+    results = {}
+
+    def load():
+        if weights_path is not None:
+            return NumpySocialLSTM.load(weights_path)
+        return NumpySocialLSTM(init_weights(config), config)
+
+    results["numpy engine startup"] = percentiles(time_call(load, repeat))
+    print_result("numpy engine startup", results["numpy engine startup"])
+
+    engine = load()
+    dimensions = [640, 480]
+    for batch_size in batch_sizes:
+        scenes = make_scenes(batch_size, obs_length, engine.max_num_peds, num_peds)
+        grids = np.stack([engine.get_grid(scene, [dimensions] * obs_length) for scene in scenes])
+        rng = np.random.RandomState(0)
+
+        def rollout():
+            engine.sample_batch(scenes, grids, [dimensions] * batch_size, pred_length, rng)
+
+        name = "numpy rollout batch {}".format(batch_size)
+        results[name] = percentiles(time_call(rollout, repeat))
+        print_result(name, results[name])
+        print("{:<40} {:.1f} scenes/s".format("", batch_size * 1000 / results[name]["mean"]))
+    return results
+
+
+def bench_anytime(engine, deadlines_ms, obs_length, pred_length, num_samples, num_peds, repeat):
+    '''
+    Latency of AnytimePredictor for every deadline, with how often it was missed and how much of the
+    prediction was kept
+    '''
+    results = {}
+    scene = make_scenes(1, obs_length, engine.max_num_peds, num_peds)[0]
+    rng = np.random.RandomState(0)
+    for deadline_ms in deadlines_ms:
+        predictor = AnytimePredictor(engine)
+        reports = []
+
+        def predict():
+            reports.append(predictor.predict(scene, [640, 480], time.monotonic() + deadline_ms / 1000.0,
+                                             pred_length, num_samples, roi=(0.5, 0.5), rng=rng)[1])
+
+        name = "anytime deadline {} ms".format(deadline_ms)
+        results[name] = percentiles(time_call(predict, repeat))
+        # the warmup call only calibrates the cost estimate
+        reports = reports[1:]
+        results[name]["missed"] = float(np.mean([report["missed_deadline"] for report in reports]))
+        results[name]["horizon"] = float(np.mean([report["horizon"] for report in reports]))
+        results[name]["samples"] = float(np.mean([report["num_samples"] for report in reports]))
+        results[name]["peds"] = float(np.mean([len(report["peds"]) for report in reports]))
+        print_result(name, results[name])
+        print("{:<40} missed {missed:.0%}, mean horizon {horizon:.1f}, samples {samples:.1f}, "
+              "peds {peds:.1f}".format("", **results[name]))
+    return results
+
+
+def get_validation_scenes(manifest, obs_length, pred_length, max_num_peds, max_windows):
+    '''
+    Up to max_windows validation windows of the manifest recordings as B x length x MNP x 3, and their dimensions
+    '''
+    from social_lstm.DataLoader import DataLoader
+    data_loader = DataLoader(1, obs_length + pred_length, max_num_peds, manifest=manifest)
+    data_loader.reset_batch_pointer(validate=True)
+    scenes, dimensions = [], []
+    for _ in range(min(data_loader.num_validate_batch, max_windows)):
+        x, _, d = data_loader.next_validate_batch(random_choose=False)
+        scenes.append(x[0])
+        dimensions.append(data_loader.dimensions[d[0]])
+    return np.stack(scenes), dimensions
+
+
+def bench_compression(weights, config, ranks, int8, scenes, dimensions, obs_length, repeat):
+    '''
+    Displacement error and step latency of the full social tensor embedding against its rank
+    factorizations, on the same scenes with the same samples. The int8 quantization only makes the
+    file smaller, the engine expands it to float32 when loading, so only its error and size are reported
+    '''
+    from social_lstm.social_sample import get_mean_error
+    variants = [("full", weights)]
+    if "embedding_t_u" in weights:
+        # trained factorized, only lower ranks are a compression
+        trained_rank = weights["embedding_t_u"].shape[1]
+        variants = [("full (rank {})".format(trained_rank), weights)]
+        skipped = [rank for rank in ranks if rank >= trained_rank]
+        if skipped:
+            print("ranks {} skipped, the model was trained with rank {}".format(skipped, trained_rank))
+        ranks = [rank for rank in ranks if rank < trained_rank]
+    variants += [("rank {}".format(rank), compress_weights(weights, rank=rank)) for rank in ranks]
+    if int8:
+        variants.append(("int8", compress_weights(weights, int8=True)))
+
+    results = {}
+    batch_size, length = scenes.shape[:2]
+    for name, variant in variants:
+        engine = NumpySocialLSTM(variant, config)
+        grids = np.stack([engine.get_grid(scene, [dimension] * length) for scene, dimension in zip(scenes, dimensions)])
+        result = {}
+        if name != "int8":
+            states = engine.observe(scenes[:, :obs_length - 1], grids[:, :obs_length - 1])
+
+            def step():
+                engine.step(scenes[:, obs_length - 1], grids[:, obs_length - 1], states)
+
+            result = percentiles(time_call(step, repeat))
+            print_result("step {} (batch {})".format(name, batch_size), result)
+        predicted = engine.sample_batch(scenes[:, :obs_length], grids[:, :obs_length], dimensions,
+                                        length - obs_length, np.random.RandomState(0))
+        result["ade"] = float(np.mean([get_mean_error(predicted[b], scenes[b], obs_length, engine.max_num_peds)
+                                       for b in range(batch_size)]))
+        result["embedding_bytes"] = int(sum(np.asarray(value).nbytes for key, value in variant.items()
+                                            if key.startswith("embedding_t")))
+        results[name] = result
+        print("{:<40} ade {ade:.5f}, social embedding {embedding_bytes} bytes".format(
+            name if name == "int8" else "", **result))
+    return results
+
+
+def bench_cold_start(save_dir, frozen_path, repeat):
+    '''
+    Time to the first prediction step: rebuilding SocialLSTMModel and restoring the checkpoint,
+    against loading the frozen graph of export.py. Importing tensorflow is timed in a new process
+    '''
+    results = {}
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, "-c", "import tensorflow"])
+    results["tensorflow import (new process)"] = percentiles([time.perf_counter() - start])
+    print_result("tensorflow import (new process)", results["tensorflow import (new process)"])
+
+    import tensorflow as tf
+    from social_lstm.model import SocialLSTMModel
+    from social_lstm.export import FrozenSocialLSTM
+
+    with open(os.path.join(save_dir, 'social_config.pkl'), 'rb') as f:
+        saved_args = pickle.load(f)
+    scenes = make_scenes(1, 2, saved_args.max_num_peds, 10)
+    if saved_args.pyramid:
+        grid = get_sequence_pyramid_mask(scenes[:, 0])
+    else:
+        grid = get_sequence_grid_mask(scenes[:, 0], [640, 480], saved_args.neighborhood_size, saved_args.grid_size)
+
+    def graph_start():
+        graph = tf.Graph()
+        with graph.as_default():
+            model = SocialLSTMModel(saved_args, True, pyramid=bool(saved_args.pyramid))
+            with tf.Session() as sess:
+                tf.train.Saver().restore(sess, tf.train.latest_checkpoint(save_dir))
+                sess.run(model.final_states, {model.input_data: scenes[:, 0], model.grid_data: grid})
+
+    def frozen_start():
+        engine = FrozenSocialLSTM(frozen_path)
+        engine.step(scenes[:, 0], grid, engine.zero_states(1))
+        engine.close()
+
+    for name, function in (("graph build + restore + first step", graph_start),
+                           ("frozen load + first step", frozen_start)):
+        results[name] = percentiles(time_call(function, repeat, warmup=0))
+        print_result(name, results[name])
+    return results
+
+
+def bench_cli_startup(commands, repeat):
+    '''
+    Wall time of "python -m social_lstm <command> --help" in a new process, interpreter start included
+    '''
+    results = {}
+    # the package has to be importable from the new process wherever it is started
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join([root] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    for command in commands:
+        def start():
+            subprocess.check_call([sys.executable, "-m", "social_lstm", command, "--help"], env=env,
+                                  stdout=subprocess.DEVNULL)
+
+        name = "cli {} --help".format(command)
+        results[name] = percentiles(time_call(start, repeat, warmup=1))
+        print_result(name, results[name])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", type=str, default=None,
+                        help="npz exported by numpy_model.py (default: random weights of the model below)")
+    parser.add_argument("--lstm_num", type=int, default=128)
+    parser.add_argument("--embedding_size", type=int, default=64)
+    parser.add_argument("--grid_size", type=int, default=4)
+    parser.add_argument("--max_num_peds", type=int, default=40)
+    parser.add_argument("--neighborhood_size", type=int, default=32)
+    parser.add_argument("--pyramid", type=int, default=0)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32],
+                        help="scenes per rollout")
+    parser.add_argument("--obs_length", type=int, default=6)
+    parser.add_argument("--pred_length", type=int, default=6)
+    parser.add_argument("--num_peds", type=int, default=10,
+                        help="peds in every synthetic scene")
+    parser.add_argument("--deadlines_ms", type=float, nargs="*", default=[5, 20, 100],
+                        help="deadlines of the anytime prediction to time")
+    parser.add_argument("--num_samples", type=int, default=10,
+                        help="samples wanted from the anytime prediction")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--compare_ranks", type=int, nargs="*", default=[],
+                        help="compare the full social tensor embedding with these rank factorizations")
+    parser.add_argument("--int8", action="store_true",
+                        help="also report the error and size of the int8 quantized social tensor embedding")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="recordings whose validation windows the comparison runs on (default: synthetic scenes)")
+    parser.add_argument("--max_windows", type=int, default=200,
+                        help="validation windows used by the comparison")
+    parser.add_argument("--cli_startup", type=str, nargs="*", default=None,
+                        help="also time the startup of these social_lstm commands (no value: all of them)")
+    parser.add_argument("--save_dir", type=str, default=None,
+                        help="also time the cold start of the tensorflow model saved here")
+    parser.add_argument("--frozen", type=str, default=None,
+                        help="frozen graph of export.py to time with --save_dir (default: save_dir/frozen/)")
+    args = parser.parse_args()
+
+    config = {"lstm_num": args.lstm_num, "embedding_size": args.embedding_size, "grid_size": args.grid_size,
+              "max_num_peds": args.max_num_peds, "neighborhood_size": args.neighborhood_size,
+              "pyramid": args.pyramid}
+    bench_numpy_engine(args.weights, config, args.batch_sizes, args.obs_length, args.pred_length, args.num_peds,
+                       args.repeat)
+    if args.deadlines_ms:
+        if args.weights is not None:
+            engine = NumpySocialLSTM.load(args.weights)
+        else:
+            engine = NumpySocialLSTM(init_weights(config), config)
+        bench_anytime(engine, args.deadlines_ms, args.obs_length, args.pred_length, args.num_samples, args.num_peds,
+                      args.repeat)
+    if args.compare_ranks or args.int8:
+        if args.weights is not None:
+            with np.load(args.weights) as data:
+                weights = {name: data[name] for name in data.files if name != "config"}
+            config = NumpySocialLSTM.load(args.weights).config
+        else:
+            weights = init_weights(config)
+        if args.manifest is not None:
+            scenes, dimensions = get_validation_scenes(args.manifest, args.obs_length, args.pred_length,
+                                                       config["max_num_peds"], args.max_windows)
+        else:
+            scenes = make_scenes(max(args.batch_sizes), args.obs_length + args.pred_length, config["max_num_peds"],
+                                 args.num_peds)
+            dimensions = [[640, 480]] * len(scenes)
+        bench_compression(weights, config, args.compare_ranks, args.int8, scenes, dimensions, args.obs_length,
+                          args.repeat)
+    if args.cli_startup is not None:
+        from social_lstm.__main__ import SUBCOMMANDS
+        bench_cli_startup(args.cli_startup or sorted(SUBCOMMANDS), min(args.repeat, 5))
+    if args.save_dir is not None:
+        frozen = args.frozen if args.frozen is not None else os.path.join(args.save_dir, "frozen")
+        bench_cold_start(args.save_dir, frozen, min(args.repeat, 5))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import os
+import glob
+import queue
+import pickle
+import threading
+import tensorflow as tf
+
+
+CHECKPOINT_PREFIX = "social_model.ckpt"
+# variables of the training state, apart from the checkpoints kept for their validation loss
+TRAINING_STATE_PREFIX = "training_state.ckpt"
+# checkpoint state file of the training state variables, so it does not replace the one of the kept checkpoints
+TRAINING_STATE_CHECKPOINT = "training_state"
+# everything else needed to continue training, see save_training_state
+TRAINING_STATE_FILE = "training_state.pkl"
+
+
+def save_training_state(sess, saver, save_dir, state, step):
+    '''
+    Save the variables (with the optimizer slots) and the python side of the training state, state is
+    any picklable dict. The pickle is replaced last, so an interrupted save leaves the previous state usable
+    params:
+    saver : tf.train.Saver of tf.global_variables(), with a small max_to_keep
+    step : global step the state was taken at, the variables are saved as TRAINING_STATE_PREFIX-step
+    '''
+    state = dict(state)
+    state["checkpoint_path"] = saver.save(sess, os.path.join(save_dir, TRAINING_STATE_PREFIX), global_step=step,
+                                          latest_filename=TRAINING_STATE_CHECKPOINT, write_meta_graph=False)
+    path = os.path.join(save_dir, TRAINING_STATE_FILE)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_training_state(save_dir):
+    '''
+    The state of save_training_state in save_dir, None if there is none
+    '''
+    path = os.path.join(save_dir, TRAINING_STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+class CheckpointWriter:
+    '''
+    Write checkpoints from a background thread, so training does not wait for the disk.
+    The training session only copies the variables to numpy (snapshot), the thread loads them into
+    its own graph, whose saver uses the names of the training variables, and saves them there.
+    Only the keep_top_k checkpoints with the best validation loss are kept, plus the ones still waiting
+    for their loss, and the checkpoint state of save_dir points at the best one, so
+    tf.train.latest_checkpoint(save_dir) is the best model like before.
+    The training state (see save_training_state) is written by the same thread, in queue order with
+    the checkpoints.
+    '''
+
+    def __init__(self, variables, save_dir, keep_top_k=5, on_saved=None, checkpoints=None,
+                 state_checkpoint_path=None):
+        '''
+        params:
+        variables : the variables to save, usually tf.global_variables() of the training graph
+        save_dir : directory to write the checkpoints to
+        keep_top_k : number of validated checkpoints kept
+        on_saved : called in the thread as on_saved(step, checkpoint_path) after every save
+        checkpoints : checkpoints already written, from get_checkpoints() of a previous run
+        state_checkpoint_path : training state variables of a previous run, removed in turn by the next states
+        '''
+        self.variables = variables
+        self.save_dir = save_dir
+        self.keep_top_k = keep_top_k
+        self.on_saved = on_saved
+        # step -> (checkpoint path, validation loss or None)
+        self.checkpoints = dict(checkpoints) if checkpoints is not None else {}
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.copies = [tf.Variable(tf.zeros(variable.get_shape(), dtype=variable.dtype.base_dtype),
+                                       trainable=False, name="snapshot_{}".format(index))
+                           for index, variable in enumerate(variables)]
+            names = {variable.op.name: copy for variable, copy in zip(variables, self.copies)}
+            self.saver = tf.train.Saver(names, max_to_keep=None)
+            # the last two training states, older ones are not needed to resume
+            self.state_saver = tf.train.Saver(names, max_to_keep=2)
+        if state_checkpoint_path is not None:
+            self.state_saver.recover_last_checkpoints([state_checkpoint_path])
+        # one thread, the training session keeps the others
+        self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto(intra_op_parallelism_threads=1,
+                                                                       inter_op_parallelism_threads=1))
+
+        self.queue = queue.Queue()
+        self.error = None
+        # snapshot loaded into the copies last, a checkpoint and a training state of the same snapshot load it once
+        self.loaded = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def snapshot(self, sess):
+        '''
+        Copy the current values of the variables out of the training session
+        '''
+        return sess.run(self.variables)
+
+    def save(self, values, step, loss=None):
+        '''
+        Queue a snapshot to be saved as checkpoint step, loss is its validation loss if already known
+        '''
+        self.check()
+        self.queue.put(("save", step, values, loss))
+
+    def save_state(self, values, state, step):
+        '''
+        Queue a snapshot and the python side of the training state to be saved with save_training_state.
+        The checkpoints kept are added to state by the thread, as they are once everything queued before is written
+        '''
+        self.check()
+        self.queue.put(("state", step, values, state))
+
+    def set_loss(self, step, loss):
+        '''
+        Validation loss of an already queued checkpoint
+        '''
+        self.check()
+        self.queue.put(("loss", step, None, loss))
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("checkpoint writer failed: {!r}".format(self.error))
+
+    def flush(self):
+        '''
+        Wait until everything queued so far is written
+        '''
+        self.queue.join()
+        self.check()
+
+    def get_checkpoints(self):
+        '''
+        The checkpoints kept so far, once everything queued is written
+        '''
+        self.flush()
+        return dict(self.checkpoints)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.sess.close()
+        self.check()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            if self.error is not None:
+                self.queue.task_done()
+                continue
+            # the validation loss, or the training state to save
+            kind, step, values, data = item
+            try:
+                if values is not None and values is not self.loaded:
+                    for copy, value in zip(self.copies, values):
+                        copy.load(value, self.sess)
+                    self.loaded = values
+                if kind == "state":
+                    state = dict(data)
+                    state["checkpoints"] = dict(self.checkpoints)
+                    save_training_state(self.sess, self.state_saver, self.save_dir, state, step)
+                else:
+                    if kind == "save":
+                        checkpoint_path = self.saver.save(self.sess, os.path.join(self.save_dir, CHECKPOINT_PREFIX),
+                                                          global_step=step, write_meta_graph=False)
+                        self.checkpoints[step] = (checkpoint_path, data)
+                        print("model saved to {}".format(checkpoint_path))
+                        if self.on_saved is not None:
+                            self.on_saved(step, checkpoint_path)
+                    elif step in self.checkpoints:
+                        self.checkpoints[step] = (self.checkpoints[step][0], data)
+                    self.apply_retention()
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def apply_retention(self):
+        validated = sorted((loss, step) for step, (_, loss) in self.checkpoints.items() if loss is not None)
+        for _, step in validated[self.keep_top_k:]:
+            checkpoint_path, _ = self.checkpoints.pop(step)
+            for path in glob.glob(checkpoint_path + ".*"):
+                os.remove(path)
+        if not self.checkpoints:
+            return
+
+        steps = sorted(self.checkpoints)
+        best_step = validated[0][1] if validated else steps[-1]
+        # the state wants the path it points at last
+        steps.remove(best_step)
+        paths = [self.checkpoints[step][0] for step in steps + [best_step]]
+        tf.train.update_checkpoint_state(self.save_dir, paths[-1], all_model_checkpoint_paths=paths)
@@ -0,0 +1,120 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+
+from social_lstm.numpy_model import NumpySocialLSTM, CONFIG_KEYS
+from social_lstm.DataLoader import DEFAULT_SAVE_DIR
+
+
+FROZEN_MODEL_FILE = "frozen_model.pb"
+# names of the nodes of the frozen graph
+CONFIG_NODE = "social_lstm_config"
+OUTPUT_NODE = "social_lstm_output"
+STATES_NODE = "social_lstm_final_states"
+
+
+def export_frozen(save_dir, output_dir, checkpoint_path=None):
+    '''
+    Write a self-contained inference graph of a trained checkpoint: the forward path of the infer model
+    with the variables turned into constants and the config embedded as a json string node
+    params:
+    save_dir : directory with social_config.pkl and the checkpoints
+    output_dir : directory to write frozen_model.pb to
+    checkpoint_path : checkpoint to export, defaults to the latest one in save_dir
+    '''
+    import tensorflow as tf
+    from social_lstm.model import SocialLSTMModel
+
+    with open(os.path.join(save_dir, 'social_config.pkl'), 'rb') as f:
+        saved_args = pickle.load(f)
+    if checkpoint_path is None:
+        checkpoint_path = tf.train.latest_checkpoint(save_dir)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        model = SocialLSTMModel(saved_args, True, pyramid=bool(saved_args.pyramid))
+        tf.concat(model.final_output, axis=0, name=OUTPUT_NODE)
+        tf.identity(model.final_states, name=STATES_NODE)
+
+        config = {key: int(getattr(saved_args, key, 0)) for key in CONFIG_KEYS}
+        config["inputs"] = {"input_data": model.input_data.name,
+                            "grid_data": model.grid_data.name,
+                            "states": model.LSTM_states.name}
+        config["outputs"] = {"output": OUTPUT_NODE + ":0", "states": STATES_NODE + ":0"}
+        config["checkpoint"] = os.path.basename(checkpoint_path)
+        tf.constant(json.dumps(config), name=CONFIG_NODE)
+
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, checkpoint_path)
+            # only what the outputs need is kept, so the loss and the optimizer are dropped
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(),
+                                                                     [OUTPUT_NODE, STATES_NODE, CONFIG_NODE])
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, FROZEN_MODEL_FILE), "wb") as f:
+        f.write(graph_def.SerializeToString())
+    return config
+
+
+class FrozenSocialLSTM(NumpySocialLSTM):
+    '''
+    Run an exported frozen graph without building SocialLSTMModel. Sampling and grids are the ones of
+    NumpySocialLSTM, only step() runs the graph
+    '''
+
+    def __init__(self, path, session_config=None):
+        import tensorflow as tf
+
+        if os.path.isdir(path):
+            path = os.path.join(path, FROZEN_MODEL_FILE)
+        graph_def = tf.GraphDef()
+        with open(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        config_node = [node for node in graph_def.node if node.name == CONFIG_NODE][0]
+        config = json.loads(config_node.attr["value"].tensor.string_val[0].decode())
+        super(FrozenSocialLSTM, self).__init__({}, config)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.graph.finalize()
+        self.sess = tf.Session(graph=self.graph, config=session_config)
+        self.inputs = config["inputs"]
+        self.outputs = config["outputs"]
+
+    def step(self, frame, grid, states):
+        # the infer graph takes one scene at a time
+        outputs = []
+        new_states = []
+        for b in range(frame.shape[0]):
+            feed = {self.inputs["input_data"]: frame[b:b + 1], self.inputs["grid_data"]: grid[b:b + 1],
+                    self.inputs["states"]: states[b]}
+            output, scene_states = self.sess.run([self.outputs["output"], self.outputs["states"]], feed)
+            outputs.append(output)
+            new_states.append(scene_states)
+        return np.stack(outputs), np.stack(new_states).astype(np.float32)
+
+    def close(self):
+        self.sess.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save_dir", type=str, default=DEFAULT_SAVE_DIR,
+                        help="directory of the config and checkpoints")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="checkpoint to export (default: the latest one)")
+    parser.add_argument("--output_dir", type=str, default=None,
+                        help="where to write frozen_model.pb (default: save_dir/frozen/)")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir if args.output_dir is not None else os.path.join(args.save_dir, "frozen")
+    config = export_frozen(args.save_dir, output_dir, args.checkpoint)
+    print("exported {} to {}".format(config["checkpoint"], os.path.join(output_dir, FROZEN_MODEL_FILE)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,45 @@
+import argparse
 import numpy as np
 
 
+# masks only hold 0 and 1, the graph casts them to float
+GRID_MASK_DTYPE = np.uint8
+
+
+def get_frames_grid_mask(frames, dimensions, neighborhood_size, grid_size):
+    '''
+    Grid masks of any number of frames at once, ... x MNP x 3 frames give ... x MNP x MNP x (grid_size**2).
+    Other ped j is in cell c of ped i when both exist, have different ids and j is inside the
+    neighborhood of i, c is counted from the lower corner of the neighborhood
+    '''
+    mnp = frames.shape[-2]
+    width, height = dimensions[0], dimensions[1]
+    width_bound, height_bound = neighborhood_size/(width*1.0), neighborhood_size/(height*1.0)
+
+    ped_id, x, y = frames[..., 0], frames[..., 1], frames[..., 2]
+    # ... x MNP x 1 for the current ped, ... x 1 x MNP for the other one
+    width_low, width_high = (x - width_bound/2)[..., :, np.newaxis], (x + width_bound/2)[..., :, np.newaxis]
+    height_low, height_high = (y - height_bound/2)[..., :, np.newaxis], (y + height_bound/2)[..., :, np.newaxis]
+    other_x, other_y = x[..., np.newaxis, :], y[..., np.newaxis, :]
+
+    in_neighborhood = ((ped_id != 0)[..., :, np.newaxis] & (ped_id != 0)[..., np.newaxis, :] &
+                       (ped_id[..., :, np.newaxis] != ped_id[..., np.newaxis, :]) &
+                       (other_x < width_high) & (other_x >= width_low) &
+                       (other_y < height_high) & (other_y >= height_low))
+
+    with np.errstate(invalid="ignore"):
+        cell_x = np.floor(((other_x - width_low)/width_bound) * grid_size)
+        cell_y = np.floor(((other_y - height_low)/height_bound) * grid_size)
+    cell = np.where(in_neighborhood, cell_x + cell_y*grid_size, -1).astype(np.int64)
+    # rounding can put a ped on the far border one cell too far
+    in_neighborhood &= (cell >= 0) & (cell < grid_size**2)
+
+    frame_mask = np.zeros(frames.shape[:-2] + (mnp, mnp, grid_size**2), dtype=GRID_MASK_DTYPE)
+    index = np.nonzero(in_neighborhood)
+    frame_mask[index + (cell[index],)] = 1
+    return frame_mask
+
+
 def getGridMask(frame, dimensions, neighborhood_size, grid_size):
     '''
     This function computes the binary mask that represents the
@@ -11,6 +50,72 @@ def getGridMask(frame, dimensions, neighborhood_size, grid_size):
     neighborhood_size : Scalar value representing the size of neighborhood considered
     grid_size : Scalar value representing the size of the grid discretization
     '''
+    return get_frames_grid_mask(frame, dimensions, neighborhood_size, grid_size)
+
+
+def get_sequence_grid_mask(sequence, dimensions, neighborhood_size, grid_size):
+    '''
+    Get the grid masks for all the frames in the sequence
+    params:
+    sequence : A numpy matrix of shape SL x MNP x 3
+    dimensions : This will be a list [width, height]
+    neighborhood_size : Scalar value representing the size of neighborhood considered
+    grid_size : Scalar value representing the size of the grid discretization
+    '''
+    return get_frames_grid_mask(sequence, dimensions, neighborhood_size, grid_size)
+
+
+def get_frames_pyramid_mask(frames, grid_size):
+    '''
+    Pyramid level of any number of frames at once, ... x MNP x 3 frames give ... x MNP x (grid_size**2)
+    '''
+    ped_id, x, y = frames[..., 0], frames[..., 1], frames[..., 2]
+    with np.errstate(invalid="ignore"):
+        section_x = np.clip(x // (1 / grid_size), 0, grid_size - 1)
+        section_y = np.clip(y // (1 / grid_size), 0, grid_size - 1)
+    section = np.where(ped_id != 0, section_x * grid_size + section_y, 0).astype(np.int64)
+
+    frame_mask = np.zeros(frames.shape[:-1] + (grid_size**2,), dtype=GRID_MASK_DTYPE)
+    index = np.nonzero(ped_id != 0)
+    frame_mask[index + (section[index],)] = 1
+    return frame_mask
+
+
+def getPyramidMask(frame, grid_size):
+    '''
+    This function computes the binary mask that represents the
+    occupancy of each ped in the other's grid
+    params:
+    frame : This will be a MNP x 3 matrix with each row being [pedID, x, y]
+    grid_size : Scalar value representing the size of the grid discretization
+    '''
+    return get_frames_pyramid_mask(frame, grid_size)
+
+
+def get_sequence_pyramid_mask(sequence):
+    sl = sequence.shape[0]
+    mnp = sequence.shape[1]
+    sequence_mask = np.zeros((sl, mnp, 1 ** 2 + 2 ** 2 + 4 ** 2), dtype=GRID_MASK_DTYPE)
+
+    sequence_mask[:, :, :1] = get_frames_pyramid_mask(sequence, 1)
+    sequence_mask[:, :, 1:5] = get_frames_pyramid_mask(sequence, 2)
+    sequence_mask[:, :, 5:21] = get_frames_pyramid_mask(sequence, 4)
+
+    return sequence_mask
+
+
+# getGridMask and getPyramidMask as they were before the masks were vectorized, unchanged, to check the
+# vectorized masks against
+def _reference_grid_mask(frame, dimensions, neighborhood_size, grid_size):
+    '''
+    This function computes the binary mask that represents the
+    occupancy of each ped in the other's grid
+    params:
+    frame : This will be a MNP x 3 matrix with each row being [pedID, x, y]
+    dimensions : This will be a list [width, height]
+    neighborhood_size : Scalar value representing the size of neighborhood considered
+    grid_size : Scalar value representing the size of the grid discretization
+    '''
 
     # Maximum number of pedestrians
     mnp = frame.shape[0]
@@ -61,26 +166,7 @@ def getGridMask(frame, dimensions, neighborhood_size, grid_size):
     return frame_mask
 
 
-def get_sequence_grid_mask(sequence, dimensions, neighborhood_size, grid_size):
-    '''
-    Get the grid masks for all the frames in the sequence
-    params:
-    sequence : A numpy matrix of shape SL x MNP x 3
-    dimensions : This will be a list [width, height]
-    neighborhood_size : Scalar value representing the size of neighborhood considered
-    grid_size : Scalar value representing the size of the grid discretization
-    '''
-    sl = sequence.shape[0]
-    mnp = sequence.shape[1]
-    sequence_mask = np.zeros((sl, mnp, mnp, grid_size**2))
-
-    for i in range(sl):
-        sequence_mask[i, :, :, :] = getGridMask(sequence[i, :, :], dimensions, neighborhood_size, grid_size)
-
-    return sequence_mask
-
-
-def getPyramidMask(frame, grid_size):
+def _reference_pyramid_mask(frame, grid_size):
     '''
     This function computes the binary mask that represents the
     occupancy of each ped in the other's grid
@@ -114,14 +200,110 @@ def getPyramidMask(frame, grid_size):
     return frame_mask
 
 
-def get_sequence_pyramid_mask(sequence):
-    sl = sequence.shape[0]
-    mnp = sequence.shape[1]
-    sequence_mask = np.zeros((sl, mnp, 1 ** 2 + 2 ** 2 + 4 ** 2))
+def get_border_pairs(frame, dimensions, neighborhood_size, grid_size):
+    '''
+    MNP x MNP pairs (ped, other ped) where the other ped is inside the neighborhood but rounding puts it past the
+    last cell, cell_x + cell_y*grid_size >= grid_size**2. The loop of _reference_grid_mask fails with an IndexError
+    there and the vectorized mask leaves the pair out, everywhere else they are the same (cell_x == grid_size on
+    another row marks the first cell of the next row in both)
+    '''
+    width_bound, height_bound = neighborhood_size/(dimensions[0]*1.0), neighborhood_size/(dimensions[1]*1.0)
+    ped_id, x, y = frame[:, 0], frame[:, 1], frame[:, 2]
+    # bounds computed like the loop, on the border a different rounding changes the result
+    width_low, width_high = (x - width_bound/2)[:, np.newaxis], (x + width_bound/2)[:, np.newaxis]
+    height_low, height_high = (y - height_bound/2)[:, np.newaxis], (y + height_bound/2)[:, np.newaxis]
+    other_x, other_y = x[np.newaxis, :], y[np.newaxis, :]
+    in_neighborhood = ((ped_id != 0)[:, np.newaxis] & (ped_id != 0)[np.newaxis, :] &
+                       (ped_id[:, np.newaxis] != ped_id[np.newaxis, :]) &
+                       (other_x < width_high) & (other_x >= width_low) &
+                       (other_y < height_high) & (other_y >= height_low))
+    cell_x = np.floor(((other_x - width_low)/width_bound) * grid_size)
+    cell_y = np.floor(((other_y - height_low)/height_bound) * grid_size)
+    return in_neighborhood & (cell_x + cell_y*grid_size >= grid_size**2)
 
-    for i in range(sl):
-        sequence_mask[i, :, :1] = getPyramidMask(sequence[i, :], 1)
-        sequence_mask[i, :, 1:5] = getPyramidMask(sequence[i, :], 2)
-        sequence_mask[i, :, 5:21] = getPyramidMask(sequence[i, :], 4)
 
-    return sequence_mask
+def check_against_reference(num_frames=1000, max_num_peds=20, grid_size=4, neighborhood_size=32,
+                            dimensions=(640, 480), seed=1):
+    '''
+    Compare the vectorized grid and pyramid masks with the loops they replaced on random frames.
+    The grid masks may only differ where the loop fails on a pair of get_border_pairs, returns the number of
+    frames whose grid mask differs otherwise, whose pyramid mask differs, and the number of frames with border pairs
+    params:
+    num_frames : number of random frames
+    max_num_peds : MNP of the frames
+    seed : seed of the random frames
+    '''
+    rng = np.random.RandomState(seed)
+    width_bound, height_bound = neighborhood_size/(dimensions[0]*1.0), neighborhood_size/(dimensions[1]*1.0)
+    frames = np.zeros((num_frames, max_num_peds, 3))
+    for frame in frames:
+        num_peds = rng.randint(0, max_num_peds + 1)
+        slots = rng.choice(max_num_peds, num_peds, replace=False)
+        frame[slots, 0] = rng.choice(np.arange(1, 4 * max_num_peds), num_peds, replace=False)
+        # a bit outside of [0, 1] to hit the clipping of the pyramid and the borders of the grid
+        frame[slots, 1:] = rng.uniform(-0.1, 1.1, (num_peds, 2))
+        if num_peds > 2:
+            # a ped on the far corner of the neighborhood of another one, then a chain of peds just inside the far
+            # corner of the previous one, where rounding can give the cell past the last one
+            frame[slots[1], 1:] = frame[slots[0], 1:] + [width_bound/2, height_bound/2]
+            for previous, ped in zip(slots[1:num_peds // 2], slots[2:num_peds // 2 + 1]):
+                frame[ped, 1:] = frame[previous, 1:] + [np.nextafter(width_bound/2, 0),
+                                                        np.nextafter(height_bound/2, 0)]
+
+    grid = get_frames_grid_mask(frames, dimensions, neighborhood_size, grid_size)
+    pyramid = get_sequence_pyramid_mask(frames)
+    grid_errors, pyramid_errors, border_frames = 0, 0, 0
+    for i, frame in enumerate(frames):
+        border = get_border_pairs(frame, dimensions, neighborhood_size, grid_size)
+        border_frames += int(border.any())
+        # pairs whose reference cell is known
+        compared = np.ones_like(border)
+        try:
+            reference_grid = _reference_grid_mask(frame, dimensions, neighborhood_size, grid_size)
+            different = False
+        except IndexError:
+            # the cell of a pair only depends on its two peds, the loop is run on every two peds on their own
+            # (both directions at once) and must fail exactly where one of the directions is a border pair
+            reference_grid = np.zeros(grid[i].shape)
+            different = bool(np.any(grid[i][border]))
+            slots = np.nonzero(frame[:, 0])[0]
+            for index, ped in enumerate(slots):
+                for other in slots[index + 1:]:
+                    try:
+                        pair_grid = _reference_grid_mask(frame[[ped, other]], dimensions, neighborhood_size,
+                                                         grid_size)
+                        reference_grid[ped, other], reference_grid[other, ped] = pair_grid[0, 1], pair_grid[1, 0]
+                        failed = False
+                    except IndexError:
+                        compared[ped, other] = compared[other, ped] = False
+                        failed = True
+                    different |= failed != (border[ped, other] or border[other, ped])
+        different |= not np.array_equal(grid[i][compared], reference_grid[compared])
+        grid_errors += int(different)
+        reference_pyramid = np.concatenate([_reference_pyramid_mask(frame, size) for size in (1, 2, 4)], axis=1)
+        pyramid_errors += int(not np.array_equal(pyramid[i], reference_pyramid))
+    return grid_errors, pyramid_errors, border_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="check the vectorized masks against the per-ped loops")
+    parser.add_argument("--num_frames", type=int, default=1000,
+                        help="number of random frames")
+    parser.add_argument("--max_num_peds", type=int, default=20,
+                        help="max number of peds of a frame")
+    parser.add_argument("--grid_size", type=int, default=4,
+                        help="grid size of the grid masks")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed of the random frames")
+    args = parser.parse_args()
+
+    grid_errors, pyramid_errors, border_frames = check_against_reference(args.num_frames, args.max_num_peds,
+                                                                         args.grid_size, seed=args.seed)
+    print("frames with a different grid / pyramid mask: {} / {} of {}, {} frames with a ped on a border, "
+          "left out of the vectorized grid".format(grid_errors, pyramid_errors, args.num_frames, border_frames))
+    if grid_errors or pyramid_errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+import os
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+
+
+# files of a preprocessed recording, next to its meta.json
+FRAME_DATA_FILE = "frame_data.bin"
+FRAME_LIST_FILE = "frame_list.bin"
+NUM_PEDS_FILE = "num_peds.bin"
+
+# coordinates are normalized to [0, 1] and ped ids stay exact in float32 up to 2 ** 24
+FRAME_DATA_DTYPE = np.float32
+FRAME_LIST_DTYPE = np.float64
+NUM_PEDS_DTYPE = np.int32
+
+# bytes read from the annotation file at once
+READ_SIZE = 1 << 20
+# annotations handled at once
+BLOCK_SIZE = 1 << 16
+
+
+def _is_frame_row(line):
+    # the first row of the wide layout, frame numbers in order
+    try:
+        frames = _parse_values(line.split(b","))
+    except ValueError:
+        return False
+    return len(frames) > 0 and np.all(frames == np.floor(frames)) and np.all(np.diff(frames) >= 0)
+
+
+def detect_layout(path):
+    '''
+    Tell the layout of an annotation file from its first lines
+    "wide" : the 4 row layout of pixel_pos.csv, rows are frame, ped, y, x
+    "long" : one annotation per row, columns are frame, ped, x, y and possibly more, with an optional header
+    "obsmat" : ETH obsmat.txt in world coordinates, space separated columns frame, ped, x, z, y, ...
+               it needs the homography of the camera, see iter_obsmat_blocks
+    '''
+    with open(path, "rb") as f:
+        first_line = f.readline(READ_SIZE)
+        if b"," not in first_line and len(first_line.split()) >= 5:
+            return "obsmat"
+        if first_line.count(b",") < 3 or not first_line.endswith(b"\n"):
+            # too few columns for an annotation, or longer than any annotation row
+            return "wide"
+        # the wide layout is exactly 4 rows of the same length, the first one frame numbers
+        lines = [first_line] + [f.readline(READ_SIZE) for _ in range(4)]
+    lines = [line for line in lines if line.strip()]
+    if (len(lines) == 4 and all(line.count(b",") == first_line.count(b",") for line in lines) and
+            _is_frame_row(first_line)):
+        return "wide"
+    return "long"
+
+
+def _row_offsets(path, num_rows):
+    # byte offset of the start of each of the first num_rows lines
+    offsets = [0]
+    position = 0
+    with open(path, "rb") as f:
+        while len(offsets) < num_rows:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            start = 0
+            while len(offsets) < num_rows:
+                end = chunk.find(b"\n", start)
+                if end < 0:
+                    break
+                offsets.append(position + end + 1)
+                start = end + 1
+            position += len(chunk)
+    if len(offsets) < num_rows:
+        raise ValueError("{} has less than {} rows".format(path, num_rows))
+    return offsets
+
+
+def _parse_values(tokens):
+    tokens = [token.strip() for token in tokens]
+    return np.array([token for token in tokens if token], dtype=np.bytes_).astype(np.float64)
+
+
+def _iter_row_values(f, block_size):
+    '''
+    Yield the values of the comma separated line f is positioned on, block_size values at a time
+    '''
+    pending = []
+    num_pending = 0
+    rest = b""
+    done = False
+    while not done:
+        chunk = f.read(READ_SIZE)
+        end = chunk.find(b"\n")
+        if end >= 0:
+            chunk = chunk[:end]
+            done = True
+        if not chunk:
+            done = True
+
+        tokens = (rest + chunk).split(b",")
+        # the last token may continue in the next chunk
+        rest = b"" if done else tokens.pop()
+        values = _parse_values(tokens)
+        pending.append(values)
+        num_pending += len(values)
+
+        while num_pending >= block_size or (done and num_pending > 0):
+            values = np.concatenate(pending)
+            yield values[:block_size]
+            pending = [values[block_size:]]
+            num_pending = len(pending[0])
+
+
+def iter_wide_blocks(path, block_size=BLOCK_SIZE):
+    '''
+    Read the 4 row layout in column blocks. Every row is read through its own file handle,
+    so only block_size columns are in memory at a time
+    Yields arrays of shape [n, 4] with columns frame, ped, x, y
+    '''
+    offsets = _row_offsets(path, 4)
+    files = [open(path, "rb") for _ in range(4)]
+    try:
+        for f, offset in zip(files, offsets):
+            f.seek(offset)
+        rows = [_iter_row_values(f, block_size) for f in files]
+        for frame, ped, y, x in itertools.zip_longest(*rows):
+            if any(row is None for row in (frame, ped, y, x)) or not len(frame) == len(ped) == len(y) == len(x):
+                raise ValueError("rows of {} do not have the same length".format(path))
+            yield np.stack([frame, ped, x, y], axis=1)
+    finally:
+        for f in files:
+            f.close()
+
+
+def iter_long_blocks(path, block_size=BLOCK_SIZE):
+    '''
+    Read the frame,ped,x,y layout in row blocks, a header line is skipped
+    Yields arrays of shape [n, 4] with columns frame, ped, x, y
+    '''
+    with open(path, "r") as f:
+        first_line = True
+        while True:
+            lines = list(itertools.islice(f, block_size))
+            if not lines:
+                break
+            if first_line:
+                first_line = False
+                try:
+                    float(lines[0].split(",")[0])
+                except ValueError:
+                    lines = lines[1:]
+            lines = [line for line in lines if line.strip()]
+            if lines:
+                yield np.loadtxt(lines, delimiter=",", ndmin=2)[:, :4]
+
+
+def load_homography(homography):
+    '''
+    3 x 3 homography from world to image coordinates, given as the path of an H.txt or as a matrix
+    '''
+    if isinstance(homography, str):
+        with open(homography, "r") as f:
+            homography = np.loadtxt([line.replace(",", " ") for line in f if line.strip()], ndmin=2)
+    homography = np.asarray(homography, dtype=np.float64)
+    if homography.shape != (3, 3):
+        raise ValueError("a homography is 3 x 3, got {}".format(homography.shape))
+    return homography
+
+
+def world_to_pixel(world_x, world_y, homography, dimensions):
+    '''
+    Normalized image coordinates of world positions, as data/getPixelCoordinates.m computes them:
+    [u, v, w] = pinv(H) [x, y, 1], then x = (v / w) / width and y = (u / w) / height
+    params:
+    world_x, world_y : arrays of world positions
+    homography : 3 x 3 world to image homography
+    dimensions : [width, height] of the image
+    Returns x and y
+    '''
+    positions = np.stack([world_x, world_y, np.ones_like(world_x)])
+    u, v, w = np.matmul(np.linalg.pinv(homography), positions)
+    return (v / w) / dimensions[0], (u / w) / dimensions[1]
+
+
+def iter_obsmat_blocks(path, homography, dimensions, block_size=BLOCK_SIZE):
+    '''
+    Read an ETH obsmat.txt (columns frame, ped, x, z, y, vx, vz, vy in world coordinates) in row blocks
+    and map the positions to normalized image coordinates with world_to_pixel
+    Yields arrays of shape [n, 4] with columns frame, ped, x, y
+    '''
+    homography = load_homography(homography)
+    with open(path, "r") as f:
+        while True:
+            lines = list(itertools.islice(f, block_size))
+            if not lines:
+                break
+            lines = [line.replace(",", " ") for line in lines if line.strip()]
+            if lines:
+                data = np.loadtxt(lines, ndmin=2)
+                x, y = world_to_pixel(data[:, 2], data[:, 4], homography, dimensions)
+                yield np.stack([data[:, 0], data[:, 1], x, y], axis=1)
+
+
+def iter_annotation_blocks(path, layout="auto", block_size=BLOCK_SIZE, homography=None, dimensions=None):
+    '''
+    Blocks of frame, ped, x, y of an annotation file, homography and dimensions are needed by the
+    obsmat layout only
+    '''
+    if layout == "auto":
+        layout = detect_layout(path)
+    if layout == "wide":
+        return iter_wide_blocks(path, block_size)
+    elif layout == "long":
+        return iter_long_blocks(path, block_size)
+    elif layout == "obsmat":
+        if homography is None:
+            raise ValueError("{} is in world coordinates, its homography is needed".format(path))
+        return iter_obsmat_blocks(path, homography, dimensions, block_size)
+    raise ValueError("unknown annotation layout {}".format(layout))
+
+
+def _write_array(path, array, offset):
+    # write array at byte offset of the file and cut the file there, so a failed write can be redone
+    with open(path, "r+b" if offset > 0 else "wb") as f:
+        f.seek(offset)
+        array.tofile(f)
+        f.truncate()
+
+
+def write_frame_data(cache_path, blocks, max_num_peds, num_frames=0):
+    '''
+    Write the [frame, ped, 3] tensor (3 is ID, x, y) of a recording to cache_path, block by block.
+    Peak memory depends on the block size and the number of frames, not on the size of the file
+    params:
+    cache_path : directory of the preprocessed recording
+    blocks : callable returning a new iterator over [n, 4] blocks of frame, ped, x, y
+    max_num_peds : Maximum number of pedestrians in a frame
+    num_frames : number of frames already written, the new frames are appended after them and must all
+                 come later than the last written frame
+    Returns the number of frames of the recording after writing
+    '''
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    frame_list_path = os.path.join(cache_path, FRAME_LIST_FILE)
+    num_peds_path = os.path.join(cache_path, NUM_PEDS_FILE)
+    frame_data_path = os.path.join(cache_path, FRAME_DATA_FILE)
+
+    # first pass: what frames do data have
+    frames = set()
+    for block in blocks():
+        frames.update(np.unique(block[:, 0]).tolist())
+    frame_list = np.array(sorted(frames), dtype=FRAME_LIST_DTYPE)
+    num_new_frames = len(frame_list)
+
+    if num_frames > 0 and num_new_frames > 0:
+        last_frame = np.fromfile(frame_list_path, dtype=FRAME_LIST_DTYPE, count=1,
+                                 offset=(num_frames - 1) * np.dtype(FRAME_LIST_DTYPE).itemsize)[0]
+        if frame_list[0] <= last_frame:
+            raise ValueError("appended frames must come after frame {}".format(last_frame))
+
+    # second pass: put every annotation in the next free ped slot of its frame
+    num_peds_data = np.zeros(num_new_frames, dtype=NUM_PEDS_DTYPE)
+    frame_bytes = max_num_peds * 3 * np.dtype(FRAME_DATA_DTYPE).itemsize
+    with open(frame_data_path, "r+b" if num_frames > 0 else "wb") as f:
+        f.truncate((num_frames + num_new_frames) * frame_bytes)
+    if num_new_frames > 0:
+        frame_data = np.memmap(frame_data_path, dtype=FRAME_DATA_DTYPE, mode="r+", offset=num_frames * frame_bytes,
+                               shape=(num_new_frames, max_num_peds, 3))
+        # appending over a failed write, clear it first
+        frame_data[:] = 0
+        for block in blocks():
+            frame_index = np.searchsorted(frame_list, block[:, 0])
+            # rank of each annotation among the ones of the same frame in this block
+            order = np.argsort(frame_index, kind="stable")
+            sorted_index = frame_index[order]
+            group_start = np.r_[0, np.flatnonzero(np.diff(sorted_index)) + 1]
+            group_size = np.diff(np.r_[group_start, len(sorted_index)])
+            rank = np.arange(len(sorted_index)) - np.repeat(group_start, group_size)
+
+            slot = np.empty_like(frame_index)
+            slot[order] = num_peds_data[sorted_index] + rank
+            np.add.at(num_peds_data, frame_index, 1)
+            if slot.max() >= max_num_peds:
+                raise ValueError("a frame has more than max_num_peds={} pedestrians".format(max_num_peds))
+
+            frame_data[frame_index, slot, 0] = block[:, 1]
+            frame_data[frame_index, slot, 1] = block[:, 2]
+            frame_data[frame_index, slot, 2] = block[:, 3]
+        frame_data.flush()
+        del frame_data
+
+    _write_array(frame_list_path, frame_list, num_frames * np.dtype(FRAME_LIST_DTYPE).itemsize)
+    _write_array(num_peds_path, num_peds_data, num_frames * np.dtype(NUM_PEDS_DTYPE).itemsize)
+    return num_frames + num_new_frames
+
+
+def load_frame_data(cache_path, num_frames, max_num_peds):
+    '''
+    Memory map the preprocessed recording, returns frame_data, frame_list and num_peds_data
+    '''
+    if num_frames == 0:
+        frame_data = np.zeros((0, max_num_peds, 3), dtype=FRAME_DATA_DTYPE)
+    else:
+        frame_data = np.memmap(os.path.join(cache_path, FRAME_DATA_FILE), dtype=FRAME_DATA_DTYPE, mode="r",
+                               shape=(num_frames, max_num_peds, 3))
+    frame_list = np.fromfile(os.path.join(cache_path, FRAME_LIST_FILE), dtype=FRAME_LIST_DTYPE).tolist()
+    num_peds_data = np.fromfile(os.path.join(cache_path, NUM_PEDS_FILE), dtype=NUM_PEDS_DTYPE).tolist()
+    return frame_data, frame_list, num_peds_data
+
+
+def main():
+    # onboard a camera: preprocess its obsmat.txt into the cache and print its manifest entry
+    from social_lstm.DataLoader import Recording, DEFAULT_DIMENSIONS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str,
+                        help="obsmat.txt of the recording (or any annotation file DataLoader reads)")
+    parser.add_argument("--homography", type=str, default=None,
+                        help="H.txt of the camera, world to image coordinates")
+    parser.add_argument("--dimensions", type=int, nargs=2, default=DEFAULT_DIMENSIONS,
+                        help="width and height of the image")
+    parser.add_argument("--name", type=str, default=None,
+                        help="name of the recording (default: the name of the directory of path)")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="where to write the preprocessed recording (default: next to path)")
+    parser.add_argument("--max_num_peds", type=int, default=40)
+    parser.add_argument("--layout", type=str, default="auto")
+    args = parser.parse_args()
+
+    name = args.name
+    if name is None:
+        name = os.path.basename(os.path.dirname(os.path.abspath(args.path)))
+    start = time.time()
+    # seq_length and the split do not change the cache
+    recording = Recording(args.path, args.dimensions, args.max_num_peds, 1, 0.2, False, name=name,
+                          cache_dir=args.cache_dir, layout=args.layout, homography=args.homography)
+    recording.prepare(force_pre_process=True)
+    print("{} frames preprocessed to {} in {:.1f}s".format(recording.num_frames, recording.cache_path,
+                                                           time.time() - start))
+    entry = {"path": os.path.abspath(args.path), "dimensions": args.dimensions, "name": name,
+             "layout": args.layout}
+    if args.homography is not None:
+        entry["homography"] = os.path.abspath(args.homography)
+    if args.cache_dir is not None:
+        print("pass --cache_dir {} to the DataLoader to use this cache".format(args.cache_dir))
+    print("manifest entry:")
+    print(json.dumps(entry))
+
+
+if __name__ == "__main__":
+    main()
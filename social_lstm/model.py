@@ -1,6 +1,7 @@
+import argparse
 import tensorflow as tf
 import numpy as np
-from social_lstm.grid import get_sequence_grid_mask, get_sequence_pyramid_mask
+from social_lstm.numpy_model import NumpySocialLSTM, CONFIG_KEYS, get_checkpoint_variables
 
 
 class SocialLSTMModel:
@@ -30,17 +31,21 @@ class SocialLSTMModel:
         self.target_data = tf.placeholder(dtype=tf.float32, shape=[args.seq_length, args.max_num_peds, 3],
                                           name="target_data")
         # frame * ped * ped * (grid * grid)
+        # the masks are fed as uint8 and cast in the graph
         if pyramid:
-            self.grid_data = tf.placeholder(dtype=tf.float32,
+            self.grid_data = tf.placeholder(dtype=tf.uint8,
                                             shape=[args.seq_length, args.max_num_peds,
                                                    1 ** 2 + 2 ** 2 + 4 ** 2],
                                             name="grid_data")
         else:
-            self.grid_data = tf.placeholder(dtype=tf.float32,
+            self.grid_data = tf.placeholder(dtype=tf.uint8,
                                             shape=[args.seq_length, args.max_num_peds, args.max_num_peds,
                                                    args.grid_size * args.grid_size],
                                             name="grid_data")
         self.lr = tf.Variable(args.learning_rate, trainable=False, name="learning_rate")
+        # the learning rate schedule feeds lr_value to lr_update, so the graph does not grow every epoch
+        self.lr_value = tf.placeholder(dtype=tf.float32, shape=[], name="lr_value")
+        self.lr_update = tf.assign(self.lr, self.lr_value)
         self.output_size = 5
 
         # Define variables for the coordinate tensor embedding layer
@@ -52,13 +57,18 @@ class SocialLSTMModel:
         # Define variables for the social tensor embedding layer
         with tf.variable_scope("tensor_embedding"):
             if pyramid:
-                self.embedding_t_w = tf.get_variable("embedding_t_w",
-                                                     [(1 ** 2 + 2 ** 2 + 4 ** 2) * self.lstm_num * 2,
-                                                      args.embedding_size],
-                                                      initializer=tf.truncated_normal_initializer(stddev=0.1))
+                tensor_size = (1 ** 2 + 2 ** 2 + 4 ** 2) * self.lstm_num * 2
             else:
-                self.embedding_t_w = tf.get_variable("embedding_t_w",
-                                                     [args.grid_size * args.grid_size * args.lstm_num * 2, args.embedding_size],
+                tensor_size = args.grid_size * args.grid_size * args.lstm_num * 2
+            # with embedding_rank the weights are factorized as embedding_t_u x embedding_t_v
+            self.embedding_rank = getattr(args, "embedding_rank", 0)
+            if self.embedding_rank > 0:
+                self.embedding_t_u = tf.get_variable("embedding_t_u", [tensor_size, self.embedding_rank],
+                                                     initializer=tf.truncated_normal_initializer(stddev=0.1))
+                self.embedding_t_v = tf.get_variable("embedding_t_v", [self.embedding_rank, args.embedding_size],
+                                                     initializer=tf.truncated_normal_initializer(stddev=0.1))
+            else:
+                self.embedding_t_w = tf.get_variable("embedding_t_w", [tensor_size, args.embedding_size],
                                                      initializer=tf.truncated_normal_initializer(stddev=0.1))
             self.embedding_t_b = tf.get_variable("embedding_t_b", [args.embedding_size],
                                                  initializer=tf.constant_initializer(0.1))
@@ -87,7 +97,8 @@ class SocialLSTMModel:
             frame_target_data = [tf.squeeze(target_, [0]) for target_ in
                                  tf.split(self.target_data, args.seq_length, axis=0)]
         with tf.name_scope("grid_frame_data_tensors"):
-            grid_frame_data = [tf.squeeze(input_, [0]) for input_ in tf.split(self.grid_data, args.seq_length, axis=0)]
+            grid_frame_data = [tf.squeeze(input_, [0]) for input_ in
+                               tf.split(tf.cast(self.grid_data, tf.float32), args.seq_length, axis=0)]
         #############################################################################
 
         # other needed variables
@@ -133,8 +144,12 @@ class SocialLSTMModel:
                     embedded_spatial_input = tf.nn.relu(
                         tf.nn.xw_plus_b(self.spatial_input, self.embedding_coord_w, self.embedding_coord_b))
                     # Embed the tensor input
-                    embedded_tensor_input = tf.nn.relu(
-                        tf.nn.xw_plus_b(self.tensor_input, self.embedding_t_w, self.embedding_t_b))
+                    if self.embedding_rank > 0:
+                        embedded_tensor_input = tf.nn.relu(tf.nn.xw_plus_b(
+                            tf.matmul(self.tensor_input, self.embedding_t_u), self.embedding_t_v, self.embedding_t_b))
+                    else:
+                        embedded_tensor_input = tf.nn.relu(
+                            tf.nn.xw_plus_b(self.tensor_input, self.embedding_t_w, self.embedding_t_b))
 
                 with tf.name_scope("concatenate_embeddings"):
                     # Concatenate the embeddings
@@ -205,6 +220,13 @@ class SocialLSTMModel:
         optimizer = tf.train.RMSPropOptimizer(self.lr)
         self.train_op = optimizer.apply_gradients(zip(grads, vars))
 
+        # gradients computed elsewhere (averaged over the workers of parallel_train.py) are fed here
+        self.gradient_data = [tf.placeholder(dtype=tf.float32, shape=tvar.get_shape(), name="gradient_data")
+                              for tvar in vars]
+        fed_grads, _ = tf.clip_by_global_norm(self.gradient_data, args.gradient_clip)
+        # the optimizer reuses the slots of train_op
+        self.apply_gradients_op = optimizer.apply_gradients(zip(fed_grads, vars))
+
     def tf_2d_normal(self, x, y, mux, muy, sx, sy, rho):
         '''
         Function that implements the PDF of a 2D normal distribution
@@ -280,93 +302,102 @@ class SocialLSTMModel:
 
         return tf.reshape(social_pyramid, [(1 ** 2 + 2 ** 2 + 4 ** 2) * self.lstm_num * 2])
 
-    def sample_gaussian_2d(self, mux, muy, sx, sy, rho):
+    def get_engine(self, sess):
         '''
-        Function to sample a point from a given 2D normal distribution
-        params:
-        mux : mean of the distribution in x
-        muy : mean of the distribution in y
-        sx : std dev of the distribution in x
-        sy : std dev of the distribution in y
-        rho : Correlation factor of the distribution
+        NumpySocialLSTM with the current weights of sess, it runs the same forward pass as the graph
         '''
-        # Extract mean
-        mean = [mux, muy]
-        # Extract covariance matrix
-        cov = [[sx * sx, rho * sx * sy], [rho * sx * sy, sy * sy]]
-        # Sample a point from the multivariate normal distribution
-        x = np.random.multivariate_normal(mean, cov, 1)
-        return x[0][0], x[0][1]
-
-    def sample(self, sess, traj, grid, dimensions, true_traj, num=10):
+        weights = sess.run({name: sess.graph.get_tensor_by_name(variable + ":0")
+                            for name, variable in get_checkpoint_variables(self.embedding_rank).items()})
+        config = {key: int(getattr(self.args, key, 0)) for key in CONFIG_KEYS if key != "pyramid"}
+        config["pyramid"] = int(self.pyramid)
+        return NumpySocialLSTM(weights, config)
+
+    def sample(self, sess, traj, grid, dimensions, true_traj, num=10, engine=None):
         # traj is a sequence of frames (of length obs_length)
         # so traj shape is (obs_length x max_num_peds x 3)
         # grid is a tensor of shape obs_length x max_num_peds x max_num_peds x (gs**2)
-        states = sess.run(self.LSTM_states)
-        # print "Fitting"
-        # For each frame in the sequence
-        for index, frame in enumerate(traj[:-1]):
-            data = np.reshape(frame, (1, self.max_num_peds, 3))
-            target_data = np.reshape(traj[index + 1], (1, self.max_num_peds, 3))
-            if self.pyramid:
-                grid_data = np.reshape(grid[index],
-                                       (1, self.max_num_peds, (1 ** 2 + 2 ** 2 + 4 ** 2)))
-            else:
-                grid_data = np.reshape(grid[index, :],
-                                       (1, self.max_num_peds, self.max_num_peds, self.grid_size * self.grid_size))
-
-            feed = {self.input_data: data, self.LSTM_states: states, self.grid_data: grid_data,
-                    self.target_data: target_data}
-
-            [states, cost] = sess.run([self.final_states, self.cost], feed)
-            # print cost
+        # true_traj is not needed to predict, it is kept for the callers
+        # The weights are read from the session once and the whole rollout, including the grids of the
+        # predicted positions and the sampling of all peds at once, is one vectorized loop, so there is
+        # no round trip to the graph for every predicted frame. Callers sampling many trajectories pass the
+        # engine of get_engine (or LoadedModel.get_engine) so the weights are not read again every time
+        if engine is None:
+            engine = self.get_engine(sess)
+        # The returned ret is of shape (obs_length+pred_length) x max_num_peds x 3
+        return engine.sample(traj, grid, dimensions, num, rng=np.random)
+
+
+# arguments of the saved config the graph of SocialLSTMModel depends on
+GRAPH_KEYS = ["lstm_num", "embedding_size", "grid_size", "max_num_peds", "seq_length", "L2_param", "gradient_clip",
+              "embedding_rank"]
+
+
+class LoadedModel:
+    '''
+    A SocialLSTMModel in its own finalized graph with its session, restored from checkpoint_path
+    '''
+
+    def __init__(self, args, infer=False, pyramid=False, session_config=None):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            # SocialLSTMModel changes the args it is given when infer is set
+            self.model = SocialLSTMModel(argparse.Namespace(**vars(args)), infer, pyramid=pyramid)
+            self.saver = tf.train.Saver()
+        self.graph.finalize()
+        self.sess = tf.Session(graph=self.graph, config=session_config)
+        self.checkpoint_path = None
+        # numpy engine of the restored weights, built on first use
+        self.engine = None
+
+    def restore(self, checkpoint_path):
+        # restoring is skipped when the checkpoint is already loaded
+        if checkpoint_path != self.checkpoint_path:
+            self.saver.restore(self.sess, checkpoint_path)
+            self.checkpoint_path = checkpoint_path
+            self.engine = None
+
+    def get_engine(self):
+        '''
+        NumpySocialLSTM of the restored checkpoint, the weights are read from the session once per checkpoint
+        '''
+        if self.engine is None:
+            self.engine = self.model.get_engine(self.sess)
+        return self.engine
 
-        ret = traj
+    def close(self):
+        self.sess.close()
 
-        last_frame = traj[-1]
 
-        prev_data = np.reshape(last_frame, (1, self.max_num_peds, 3))
-        if self.pyramid:
-            prev_grid_data = np.reshape(grid[-1],
-                                        (1, self.max_num_peds, (1 ** 2 + 2 ** 2 + 4 ** 2)))
-        else:
-            prev_grid_data = np.reshape(grid[-1],
-                                        (1, self.max_num_peds, self.max_num_peds, self.grid_size * self.grid_size))
-
-        prev_target_data = np.reshape(true_traj[traj.shape[0]], (1, self.max_num_peds, 3))
-        # Prediction
-        for t in range(num):
-            # print "**** NEW PREDICTION TIME STEP", t, "****"
-            feed = {self.input_data: prev_data, self.LSTM_states: states, self.grid_data: prev_grid_data,
-                    self.target_data: prev_target_data}
-            [output, states, cost] = sess.run([self.final_output, self.final_states, self.cost], feed)
-            # print "Cost", cost
-            # Output is a list of lists where the inner lists contain matrices of shape 1x5. The outer list contains only one element (since seq_length=1) and the inner list contains max_num_peds elements
-            # output = output[0]
-            newpos = np.zeros((1, self.max_num_peds, 3))
-            for pedindex, pedoutput in enumerate(output):
-                [o_mux, o_muy, o_sx, o_sy, o_corr] = np.split(pedoutput[0], 5, 0)
-                mux, muy, sx, sy, corr = o_mux[0], o_muy[0], np.exp(o_sx[0]), np.exp(o_sy[0]), np.tanh(o_corr[0])
-
-                next_x, next_y = self.sample_gaussian_2d(mux, muy, sx, sy, corr)
-
-                # if prev_data[0, pedindex, 0] != 0:
-                #     print "Pedestrian ID", prev_data[0, pedindex, 0]
-                #     print "Predicted parameters", mux, muy, sx, sy, corr
-                #     print "New Position", next_x, next_y
-                #     print "Target Position", prev_target_data[0, pedindex, 1], prev_target_data[0, pedindex, 2]
-                #     print
-
-                newpos[0, pedindex, :] = [prev_data[0, pedindex, 0], next_x, next_y]
-            ret = np.vstack((ret, newpos))
-            prev_data = newpos
-            if self.pyramid:
-                prev_grid_data = get_sequence_pyramid_mask(prev_data)
-            else:
-                prev_grid_data = get_sequence_grid_mask(prev_data, dimensions, self.args.neighborhood_size, self.grid_size)
+class ModelCache:
+    '''
+    Build every model configuration once per process: evaluating several checkpoints of the same
+    configuration, or the grid and the pyramid variant, only restores weights into the existing graphs
+    '''
 
-            if t != num - 1:
-                prev_target_data = np.reshape(true_traj[traj.shape[0] + t + 1], (1, self.max_num_peds, 3))
+    def __init__(self, session_config=None):
+        self.session_config = session_config
+        self.models = {}
 
-        # The returned ret is of shape (obs_length+pred_length) x max_num_peds x 3
-        return ret
+    def get(self, args, checkpoint_path=None, infer=True, pyramid=None):
+        '''
+        The LoadedModel of args, restored from checkpoint_path when given
+        params:
+        args : saved config of the model
+        infer : build the one frame sampling graph
+        pyramid : defaults to args.pyramid
+        '''
+        if pyramid is None:
+            pyramid = bool(args.pyramid)
+        key = (infer, pyramid) + tuple(getattr(args, name, 0) for name in GRAPH_KEYS
+                                       if not (infer and name == "seq_length"))
+        if key not in self.models:
+            self.models[key] = LoadedModel(args, infer, pyramid, self.session_config)
+        loaded = self.models[key]
+        if checkpoint_path is not None:
+            loaded.restore(checkpoint_path)
+        return loaded
+
+    def close(self):
+        for loaded in self.models.values():
+            loaded.close()
+        self.models = {}
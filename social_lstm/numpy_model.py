@@ -0,0 +1,362 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+
+from social_lstm.grid import get_sequence_grid_mask, get_sequence_pyramid_mask
+from social_lstm.DataLoader import DEFAULT_SAVE_DIR
+
+
+# checkpoint variable of every exported weight
+CHECKPOINT_VARIABLES = {"embedding_coord_w": "coordinate_embedding/embedding_coord_w",
+                        "embedding_coord_b": "coordinate_embedding/embedding_coord_b",
+                        "embedding_t_w": "tensor_embedding/embedding_t_w",
+                        "embedding_t_b": "tensor_embedding/embedding_t_b",
+                        "output_w": "output_layer/output_w",
+                        "output_b": "output_layer/output_b",
+                        "lstm_kernel": "LSTM/basic_lstm_cell/kernel",
+                        "lstm_bias": "LSTM/basic_lstm_cell/bias"}
+# checkpoint variables of a social tensor embedding trained with embedding_rank, instead of embedding_t_w
+FACTORIZED_VARIABLES = {"embedding_t_u": "tensor_embedding/embedding_t_u",
+                        "embedding_t_v": "tensor_embedding/embedding_t_v"}
+# arguments of the saved config the forward pass needs
+CONFIG_KEYS = ["lstm_num", "embedding_size", "grid_size", "max_num_peds", "neighborhood_size", "pyramid",
+               "embedding_rank"]
+
+PYRAMID_SIZE = 1 ** 2 + 2 ** 2 + 4 ** 2
+# added to the forget gate by BasicLSTMCell
+FORGET_BIAS = 1.0
+
+
+def get_checkpoint_variables(embedding_rank=0):
+    '''
+    Checkpoint variable of every weight of a model trained with embedding_rank
+    '''
+    variables = dict(CHECKPOINT_VARIABLES)
+    if embedding_rank > 0:
+        del variables["embedding_t_w"]
+        variables.update(FACTORIZED_VARIABLES)
+    return variables
+
+
+def factorize_embedding(weights, rank):
+    '''
+    Replace embedding_t_w by its best rank approximation embedding_t_u x embedding_t_v (truncated SVD).
+    Already factorized weights are truncated to the lower rank
+    '''
+    weights = dict(weights)
+    if "embedding_t_u" in weights:
+        w = np.matmul(weights.pop("embedding_t_u").astype(np.float64), weights.pop("embedding_t_v"))
+    else:
+        w = weights.pop("embedding_t_w").astype(np.float64)
+    u, s, vt = np.linalg.svd(w, full_matrices=False)
+    weights["embedding_t_u"] = (u[:, :rank] * s[:rank]).astype(np.float32)
+    weights["embedding_t_v"] = vt[:rank].astype(np.float32)
+    return weights
+
+
+def quantize_embedding(weights):
+    '''
+    Store embedding_t_w, or both factors embedding_t_u and embedding_t_v, as int8 with one float scale per
+    output column
+    '''
+    weights = dict(weights)
+    for name in ("embedding_t_w", "embedding_t_u", "embedding_t_v"):
+        if name in weights:
+            w = weights.pop(name)
+            scale = np.maximum(np.max(np.abs(w), axis=0), 1e-12) / 127
+            weights[name + "_int8"] = np.round(w / scale).astype(np.int8)
+            weights[name + "_scale"] = scale.astype(np.float32)
+    return weights
+
+
+def export_weights(save_dir, output_path, checkpoint_path=None, rank=0, int8=False):
+    '''
+    Export the weights of a trained SocialLSTMModel checkpoint and its config to a npz file
+    loadable by NumpySocialLSTM.load. This is the only place tensorflow is needed
+    params:
+    save_dir : directory with social_config.pkl and the checkpoints
+    output_path : npz file to write
+    checkpoint_path : checkpoint to export, defaults to the latest one in save_dir
+    rank : factorize the social tensor embedding to this rank, see factorize_embedding
+    int8 : quantize the social tensor embedding, see quantize_embedding
+    '''
+    import tensorflow as tf
+
+    with open(os.path.join(save_dir, 'social_config.pkl'), 'rb') as f:
+        saved_args = pickle.load(f)
+    if checkpoint_path is None:
+        checkpoint_path = tf.train.latest_checkpoint(save_dir)
+
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    config = {key: int(getattr(saved_args, key, 0)) for key in CONFIG_KEYS}
+    weights = {name: reader.get_tensor(variable)
+               for name, variable in get_checkpoint_variables(config["embedding_rank"]).items()}
+    weights = compress_weights(weights, rank, int8)
+    np.savez(output_path, config=json.dumps(config), **weights)
+    return config
+
+
+def compress_weights(weights, rank=0, int8=False):
+    '''
+    Post-training compression of the social tensor embedding, full or factorized (trained with embedding_rank).
+    A factorized embedding can only be truncated to a lower rank
+    '''
+    if rank > 0:
+        if "embedding_t_u" in weights and rank >= weights["embedding_t_u"].shape[1]:
+            raise ValueError("the social tensor embedding already has rank {}, it can't be factorized to "
+                             "rank {}".format(weights["embedding_t_u"].shape[1], rank))
+        weights = factorize_embedding(weights, rank)
+    if int8:
+        weights = quantize_embedding(weights)
+    return weights
+
+
+def init_weights(config, seed=0):
+    '''
+    Random weights with the shapes of SocialLSTMModel, for benchmarks without a trained model
+    '''
+    rng = np.random.RandomState(seed)
+    lstm_num, embedding_size = config["lstm_num"], config["embedding_size"]
+    if config["pyramid"]:
+        tensor_size = PYRAMID_SIZE * lstm_num * 2
+    else:
+        tensor_size = config["grid_size"] ** 2 * lstm_num * 2
+
+    def normal(*shape):
+        return (0.1 * rng.standard_normal(shape)).astype(np.float32)
+
+    weights = {"embedding_coord_w": normal(2, embedding_size),
+               "embedding_coord_b": np.full(embedding_size, 0.1, dtype=np.float32),
+               "embedding_t_w": normal(tensor_size, embedding_size),
+               "embedding_t_b": np.full(embedding_size, 0.1, dtype=np.float32),
+               "output_w": normal(lstm_num, 5),
+               "output_b": np.full(5, 0.1, dtype=np.float32),
+               "lstm_kernel": normal(2 * embedding_size + lstm_num, 4 * lstm_num),
+               "lstm_bias": np.zeros(4 * lstm_num, dtype=np.float32)}
+    if config.get("embedding_rank", 0) > 0:
+        weights = factorize_embedding(weights, config["embedding_rank"])
+    return weights
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+class NumpySocialLSTM:
+    '''
+    Forward pass of SocialLSTMModel in numpy, for serving without tensorflow.
+    Everything is batched over scenes: frames are B x MNP x 3, grids are B x MNP x MNP x (GS**2)
+    (or B x MNP x 21 for the pyramid) and states are B x MNP x (lstm_num * 2), the concatenated c and h
+    of BasicLSTMCell.
+    Like the graph, all peds of a frame are updated from the states of the previous frame, so they
+    are computed at once.
+    '''
+
+    def __init__(self, weights, config):
+        self.config = config
+        self.lstm_num = config["lstm_num"]
+        self.grid_size = config["grid_size"]
+        self.max_num_peds = config["max_num_peds"]
+        self.neighborhood_size = config["neighborhood_size"]
+        self.pyramid = bool(config["pyramid"])
+        weights = dict(weights)
+        for name in [name for name in weights if name.endswith("_int8")]:
+            # numpy has no int8 matmul, the int8 weights are expanded once here
+            base = name[:-len("_int8")]
+            weights[base] = weights.pop(name).astype(np.float32) * weights.pop(base + "_scale")
+        self.weights = {name: np.asarray(weight, dtype=np.float32) for name, weight in weights.items()}
+        # the social tensor embedding is embedding_t_u x embedding_t_v, see factorize_embedding
+        self.factorized = "embedding_t_u" in self.weights
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            config = json.loads(str(data["config"]))
+            weights = {name: data[name] for name in data.files if name != "config"}
+        return cls(weights, config)
+
+    def zero_states(self, batch_size, num_peds=None):
+        # frames can have fewer slots than max_num_peds, the weights do not depend on it
+        if num_peds is None:
+            num_peds = self.max_num_peds
+        return np.zeros((batch_size, num_peds, self.lstm_num * 2), dtype=np.float32)
+
+    def get_social_tensor(self, grid, states):
+        batch_size, num_peds = states.shape[0], states.shape[1]
+        if self.pyramid:
+            # B x 21 x (lstm_num * 2), the same for every ped
+            social_pyramid = np.matmul(np.transpose(grid, (0, 2, 1)), states)
+            social_pyramid = np.reshape(social_pyramid, (batch_size, 1, -1))
+            return np.broadcast_to(social_pyramid, (batch_size, num_peds, social_pyramid.shape[2]))
+        # B x MNP x (GS**2) x (lstm_num * 2)
+        social_tensor = np.matmul(np.transpose(grid, (0, 1, 3, 2)), states[:, np.newaxis])
+        return np.reshape(social_tensor, (batch_size, num_peds, -1))
+
+    def step(self, frame, grid, states):
+        '''
+        One frame for every scene
+        params:
+        frame : B x MNP x 3 [pedID, x, y]
+        grid : grid or pyramid mask of the frame
+        states : B x MNP x (lstm_num * 2)
+        Returns the B x MNP x 5 output (mux, muy, sx, sy, corr before exp and tanh) and the new states
+        '''
+        w = self.weights
+        frame = np.asarray(frame, dtype=np.float32)
+        grid = np.asarray(grid, dtype=np.float32)
+
+        social_tensor = self.get_social_tensor(grid, states)
+        embedded_spatial_input = np.maximum(np.matmul(frame[:, :, 1:3], w["embedding_coord_w"]) +
+                                            w["embedding_coord_b"], 0)
+        if self.factorized:
+            embedded_tensor = np.matmul(np.matmul(social_tensor, w["embedding_t_u"]), w["embedding_t_v"])
+        else:
+            embedded_tensor = np.matmul(social_tensor, w["embedding_t_w"])
+        embedded_tensor_input = np.maximum(embedded_tensor + w["embedding_t_b"], 0)
+
+        # BasicLSTMCell with state_is_tuple=False
+        c, h = np.split(states, 2, axis=2)
+        gates = np.matmul(np.concatenate([embedded_spatial_input, embedded_tensor_input, h], axis=2),
+                          w["lstm_kernel"]) + w["lstm_bias"]
+        i, j, f, o = np.split(gates, 4, axis=2)
+        new_c = c * sigmoid(f + FORGET_BIAS) + sigmoid(i) * np.tanh(j)
+        new_h = np.tanh(new_c) * sigmoid(o)
+
+        output = np.matmul(new_h, w["output_w"]) + w["output_b"]
+        return output, np.concatenate([new_c, new_h], axis=2)
+
+    def get_grid(self, frames, dimensions):
+        '''
+        Grid or pyramid masks of B x MNP x 3 frames, dimensions is a list of [width, height] per scene
+        '''
+        if self.pyramid:
+            return get_sequence_pyramid_mask(frames)
+        if all(list(scene_dimensions) == list(dimensions[0]) for scene_dimensions in dimensions):
+            # scenes of the same size are done in one go
+            return get_sequence_grid_mask(frames, dimensions[0], self.neighborhood_size, self.grid_size)
+        return np.stack([get_sequence_grid_mask(frames[b:b + 1], dimensions[b], self.neighborhood_size,
+                                                self.grid_size)[0] for b in range(frames.shape[0])])
+
+    def sample_positions(self, output, rng):
+        '''
+        Sample the next position of every ped from the B x MNP x 5 output
+        '''
+        mux, muy = output[:, :, 0], output[:, :, 1]
+        sx, sy, corr = np.exp(output[:, :, 2]), np.exp(output[:, :, 3]), np.tanh(output[:, :, 4])
+        z = rng.standard_normal(output.shape[:2] + (2,))
+        next_x = mux + sx * z[:, :, 0]
+        next_y = muy + sy * (corr * z[:, :, 0] + np.sqrt(1 - corr ** 2) * z[:, :, 1])
+        return next_x, next_y
+
+    def observe(self, trajs, grids, states=None):
+        '''
+        Run the observed frames of B scenes to get their states
+        params:
+        trajs : B x obs_length x MNP x 3
+        grids : their masks, B x obs_length x ...
+        '''
+        if states is None:
+            states = self.zero_states(trajs.shape[0], trajs.shape[2])
+        for index in range(trajs.shape[1]):
+            _, states = self.step(trajs[:, index], grids[:, index], states)
+        return states
+
+    def sample_batch(self, trajs, grids, dimensions, num=10, rng=None):
+        '''
+        Same as SocialLSTMModel.sample for B scenes at once
+        params:
+        trajs : B x obs_length x MNP x 3 observed frames
+        grids : B x obs_length x ... masks of the observed frames
+        dimensions : list of [width, height] per scene
+        num : number of frames to predict
+        rng : numpy RandomState used for sampling
+        Returns B x (obs_length + num) x MNP x 3
+        '''
+        if rng is None:
+            rng = np.random
+        trajs = np.asarray(trajs, dtype=np.float32)
+        # fit the states on all but the last observed frame, the last one starts the prediction
+        states = self.observe(trajs[:, :-1], grids[:, :-1])
+
+        prev_data = trajs[:, -1]
+        prev_grid_data = grids[:, -1]
+        predictions = []
+        for t in range(num):
+            output, states = self.step(prev_data, prev_grid_data, states)
+            next_x, next_y = self.sample_positions(output, rng)
+            newpos = np.stack([prev_data[:, :, 0], next_x, next_y], axis=2).astype(np.float32)
+            predictions.append(newpos)
+            prev_data = newpos
+            if t != num - 1:
+                prev_grid_data = self.get_grid(prev_data, dimensions)
+
+        return np.concatenate([trajs, np.stack(predictions, axis=1)], axis=1)
+
+    def sample(self, traj, grid, dimensions, num=10, rng=None):
+        '''
+        Single scene version of sample_batch, traj is obs_length x MNP x 3
+        '''
+        return self.sample_batch(np.asarray(traj)[np.newaxis], np.asarray(grid)[np.newaxis], [dimensions],
+                                 num, rng)[0]
+
+
+def check_against_graph(save_dir, weights_path, seed=1):
+    '''
+    Run one frame through the tensorflow model and the numpy engine and return the largest difference
+    of the outputs and of the states
+    '''
+    import tensorflow as tf
+    from social_lstm.model import SocialLSTMModel
+
+    with open(os.path.join(save_dir, 'social_config.pkl'), 'rb') as f:
+        saved_args = pickle.load(f)
+    engine = NumpySocialLSTM.load(weights_path)
+    model = SocialLSTMModel(saved_args, True, pyramid=bool(saved_args.pyramid))
+
+    rng = np.random.RandomState(seed)
+    mnp = saved_args.max_num_peds
+    frame = np.zeros((1, mnp, 3), dtype=np.float32)
+    num_peds = mnp // 2
+    frame[0, :num_peds, 0] = np.arange(1, num_peds + 1)
+    frame[0, :num_peds, 1:] = rng.uniform(size=(num_peds, 2))
+    grid = engine.get_grid(frame, [[640, 480]])
+    states = rng.uniform(-1, 1, size=(1, mnp, saved_args.lstm_num * 2)).astype(np.float32)
+
+    with tf.Session() as sess:
+        tf.train.Saver().restore(sess, tf.train.latest_checkpoint(save_dir))
+        feed = {model.input_data: frame, model.target_data: frame, model.grid_data: grid,
+                model.LSTM_states: states[0]}
+        output, final_states = sess.run([model.final_output, model.final_states], feed)
+
+    engine_output, engine_states = engine.step(frame, grid, states)
+    output = np.concatenate(output, axis=0)
+    return np.max(np.abs(output - engine_output[0])), np.max(np.abs(final_states - engine_states[0]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save_dir", type=str, default=DEFAULT_SAVE_DIR,
+                        help="directory of the config and checkpoints")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="checkpoint to export (default: the latest one)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="npz file to write (default: save_dir/social_weights.npz)")
+    parser.add_argument("--check", action="store_true",
+                        help="compare the numpy engine with the tensorflow graph after exporting")
+    parser.add_argument("--rank", type=int, default=0,
+                        help="factorize the social tensor embedding to this rank (default: keep it full)")
+    parser.add_argument("--int8", action="store_true",
+                        help="store the social tensor embedding as int8 (smaller file, still computed in float32)")
+    args = parser.parse_args()
+
+    output = args.output if args.output is not None else os.path.join(args.save_dir, "social_weights.npz")
+    config = export_weights(args.save_dir, output, args.checkpoint, args.rank, args.int8)
+    print("exported {} to {}".format(config, output))
+    if args.check:
+        print("max output / state difference: {} / {}".format(*check_against_graph(args.save_dir, output)))
+
+
+if __name__ == "__main__":
+    main()
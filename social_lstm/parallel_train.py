@@ -0,0 +1,203 @@
+import os
+import queue
+import random
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+
+from social_lstm.shared_data import SharedDataset, attach, get_shared_memory_dir
+from social_lstm.utils import pin_threads
+
+
+def get_shard_sizes(batch_size, num_workers):
+    '''
+    Sequences of a batch computed by every worker, the first ones take the remainder
+    '''
+    return [batch_size // num_workers + (1 if rank < batch_size % num_workers else 0) for rank in range(num_workers)]
+
+
+def run_worker(rank, args, spec, buffers, commands, results):
+    '''
+    Body of one gradient worker: on every command, load the parameters the coordinator published,
+    compute the gradients of its shard of the batch and write their sum to its row of the gradient buffer
+    '''
+    # pin the thread pools before tensorflow is imported in this process
+    threads = max(getattr(args, "threads_per_worker", 1), 1)
+    pin_threads(threads)
+    try:
+        import tensorflow as tf
+        from social_lstm.model import SocialLSTMModel
+        from social_lstm.train import get_feed
+
+        seed = getattr(args, "seed", None)
+        # every worker draws its own windows, reproducible for a fixed seed and number of workers
+        random.seed(None if seed is None else seed * 1000 + rank)
+        data_loader = attach(spec, buffers["shard_sizes"][rank])
+
+        model = SocialLSTMModel(args, pyramid=bool(args.pyramid))
+        variables = tf.trainable_variables()
+        parameter_data = [tf.placeholder(dtype=tf.float32, shape=variable.get_shape()) for variable in variables]
+        load_parameters = tf.group(*[tf.assign(variable, data) for variable, data in zip(variables, parameter_data)])
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)
+        sess = tf.Session(config=config)
+        sess.run(tf.global_variables_initializer())
+
+        parameters = np.memmap(buffers["parameters"], dtype=np.float32, mode="r", shape=(buffers["size"],))
+        gradients = np.memmap(buffers["gradients"], dtype=np.float32, mode="r+",
+                              shape=(buffers["num_workers"], buffers["size"]))
+        offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in buffers["shapes"]])
+        results.put(("ready", rank, None))
+    except Exception as e:
+        results.put(("failed", rank, repr(e)))
+        raise
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        try:
+            if command == "get_state":
+                results.put(("state", rank, {"random": random.getstate(), "loader": data_loader.get_state()}))
+                continue
+            if isinstance(command, tuple) and command[0] == "set_state":
+                random.setstate(command[1]["random"])
+                data_loader.set_state(command[1]["loader"])
+                results.put(("state", rank, None))
+                continue
+
+            feed = {data: parameters[offsets[i]:offsets[i + 1]].reshape(shape)
+                    for i, (data, shape) in enumerate(zip(parameter_data, buffers["shapes"]))}
+            sess.run(load_parameters, feed)
+
+            x, y, d = data_loader.next_training_batch()
+            gradient_sum = np.zeros(buffers["size"], dtype=np.float32)
+            loss_sum = 0
+            for batch in range(data_loader.batch_size):
+                feed = get_feed(model, args, data_loader, x[batch], y[batch], d[batch])
+                loss, grads = sess.run([model.cost, model.gradients], feed)
+                loss_sum += loss
+                for i, grad in enumerate(grads):
+                    if grad is not None:
+                        gradient_sum[offsets[i]:offsets[i + 1]] += np.ravel(grad)
+            gradients[rank] = gradient_sum
+            results.put(("done", rank, loss_sum))
+        except Exception as e:
+            results.put(("failed", rank, repr(e)))
+            raise
+    sess.close()
+
+
+class GradientWorkers:
+    '''
+    Synchronous data-parallel training on the local cores. Every step the coordinator publishes the
+    trainable variables to shared memory, each of num_workers processes computes the gradients of its
+    shard of the batch, and the coordinator averages them in worker order and applies them once with
+    model.apply_gradients_op. For a fixed seed and number of workers the result is reproducible.
+    The workers read the frames from a SharedDataset of data_loader.
+    '''
+
+    def __init__(self, args, data_loader, variables, num_workers):
+        '''
+        params:
+        args : training arguments, the workers build the same model
+        data_loader : DataLoader to shard the batches of
+        variables : trainable variables of the coordinator model, in tf.trainable_variables() order
+        num_workers : number of worker processes, at most data_loader.batch_size
+        '''
+        self.num_workers = min(num_workers, data_loader.batch_size)
+        self.batch_size = data_loader.batch_size
+        self.variables = variables
+        self.shapes = [variable.get_shape().as_list() for variable in variables]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.size = sum(self.sizes)
+
+        self.path = tempfile.mkdtemp(prefix="social_lstm_grads_", dir=get_shared_memory_dir())
+        buffers = {"parameters": os.path.join(self.path, "parameters.bin"),
+                   "gradients": os.path.join(self.path, "gradients.bin"),
+                   "shapes": self.shapes,
+                   "size": self.size,
+                   "num_workers": self.num_workers,
+                   "shard_sizes": get_shard_sizes(self.batch_size, self.num_workers)}
+        self.parameters = np.memmap(buffers["parameters"], dtype=np.float32, mode="w+", shape=(self.size,))
+        self.gradients = np.memmap(buffers["gradients"], dtype=np.float32, mode="w+",
+                                   shape=(self.num_workers, self.size))
+
+        self.shared = SharedDataset(data_loader)
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        self.commands = [context.Queue() for _ in range(self.num_workers)]
+        self.processes = [context.Process(target=run_worker,
+                                          args=(rank, args, self.shared.spec, buffers, self.commands[rank],
+                                                self.results),
+                                          daemon=True)
+                          for rank in range(self.num_workers)]
+        for process in self.processes:
+            process.start()
+        self.wait("ready")
+
+    def wait(self, kind):
+        '''
+        One message of every worker, in rank order
+        '''
+        messages = [None] * self.num_workers
+        while any(message is None for message in messages):
+            try:
+                message_kind, rank, value = self.results.get(timeout=1.0)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    raise RuntimeError("a gradient worker exited")
+                continue
+            if message_kind == "failed":
+                raise RuntimeError("gradient worker {} failed: {}".format(rank, value))
+            if message_kind == kind:
+                messages[rank] = value
+        return messages
+
+    def step(self, sess, model):
+        '''
+        One synchronous training step on a batch, returns its mean loss
+        '''
+        self.parameters[:] = np.concatenate([np.ravel(value) for value in sess.run(self.variables)])
+        for commands in self.commands:
+            commands.put("step")
+        losses = self.wait("done")
+
+        # summed in worker order, so the average does not depend on which worker finished first
+        gradient = np.zeros(self.size, dtype=np.float64)
+        for rank in range(self.num_workers):
+            gradient += self.gradients[rank]
+        gradient = (gradient / self.batch_size).astype(np.float32)
+
+        offsets = np.cumsum([0] + self.sizes)
+        feed = {data: gradient[offsets[i]:offsets[i + 1]].reshape(shape)
+                for i, (data, shape) in enumerate(zip(model.gradient_data, self.shapes))}
+        sess.run(model.apply_gradients_op, feed)
+        return sum(losses) / self.batch_size
+
+    def get_state(self):
+        '''
+        Random state and loader position of every worker, in rank order
+        '''
+        for commands in self.commands:
+            commands.put("get_state")
+        return self.wait("state")
+
+    def set_state(self, states):
+        '''
+        Continue from the states of get_state, taken with the same number of workers
+        '''
+        if len(states) != self.num_workers:
+            raise ValueError("state of {} gradient workers can't be restored on {}".format(len(states),
+                                                                                           self.num_workers))
+        for commands, state in zip(self.commands, states):
+            commands.put(("set_state", state))
+        self.wait("state")
+
+    def close(self):
+        for commands in self.commands:
+            commands.put(None)
+        for process in self.processes:
+            process.join()
+        self.shared.close()
+        shutil.rmtree(self.path, ignore_errors=True)
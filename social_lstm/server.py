@@ -0,0 +1,261 @@
+import os
+import time
+import json
+import socket
+import asyncio
+import argparse
+import collections
+import numpy as np
+
+from social_lstm.numpy_model import NumpySocialLSTM
+from social_lstm.DataLoader import DEFAULT_SAVE_DIR
+from social_lstm.utils import percentiles
+
+
+class Request:
+    def __init__(self, request_id, traj, dimensions, pred_length, deadline):
+        self.request_id = request_id
+        # obs_length x MNP x 3
+        self.traj = traj
+        self.dimensions = dimensions
+        self.pred_length = pred_length
+        # time.monotonic() after which the answer is useless, or None
+        self.deadline = deadline
+        self.received = time.monotonic()
+        # requests are parsed in PredictionServer.submit, inside the running loop
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class Metrics:
+    '''
+    Counters and latency of the server, latencies are kept for the last window requests
+    '''
+
+    def __init__(self, window=1000):
+        self.start = time.monotonic()
+        self.counts = collections.Counter()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+
+    def report(self, queue_size):
+        uptime = time.monotonic() - self.start
+        report = {"uptime_s": uptime,
+                  "queue_size": queue_size,
+                  "throughput_per_s": self.counts["completed"] / uptime if uptime > 0 else 0.0}
+        report.update(self.counts)
+        if self.latencies:
+            report["latency_ms"] = percentiles(list(self.latencies))
+        if self.batch_sizes:
+            report["mean_batch_size"] = float(np.mean(self.batch_sizes))
+        return report
+
+
+class PredictionServer:
+    '''
+    Serve predictions of many scenes at once. Requests arriving within batch_window seconds of each
+    other are run as one batched rollout of the numpy engine.
+    Every line sent by a client is a json request
+        {"id": ..., "traj": [[[pedID, x, y], ...], ...], "dimensions": [width, height],
+         "pred_length": 6, "deadline_ms": 100}
+    where traj holds the observed frames (at most max_num_peds peds over all of them, in any order, dimensions
+    defaults to [640, 480]). The answer is {"id": ..., "pred": [[[pedID, x, y], ...], ...]} with the pred_length
+    predicted frames of the peds of the last observed frame,
+    or {"id": ..., "error": ...} when the server is overloaded (backpressure), the deadline passed
+    or the request is invalid. {"metrics": true} answers the current metrics.
+    '''
+
+    def __init__(self, engine, max_batch_size=32, batch_window=0.005, max_queue=256, seed=None):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.metrics = Metrics()
+        self.rng = np.random.RandomState(seed)
+
+    def parse_request(self, message):
+        frames = [np.asarray(frame, dtype=np.float32).reshape(-1, 3) for frame in message["traj"]]
+        if len(frames) == 0:
+            raise ValueError("no observed frame")
+        frames = [frame[frame[:, 0] != 0] for frame in frames]
+        # every ped keeps one slot over all the observed frames, like DataLoader.get_sequence, so its state and
+        # grid row do not pass to another ped when the order of a frame changes
+        ped_ids = np.unique(np.concatenate([frame[:, 0] for frame in frames]))
+        if len(ped_ids) > self.engine.max_num_peds:
+            raise ValueError("more than {} peds in the observed frames".format(self.engine.max_num_peds))
+        traj = np.zeros((len(frames), self.engine.max_num_peds, 3), dtype=np.float32)
+        for index, frame in enumerate(frames):
+            if len(np.unique(frame[:, 0])) != len(frame):
+                raise ValueError("a ped is twice in frame {}".format(index))
+            traj[index, np.searchsorted(ped_ids, frame[:, 0])] = frame
+        pred_length = int(message.get("pred_length", 6))
+        if pred_length < 1:
+            raise ValueError("pred_length must be at least 1")
+        deadline = None
+        if message.get("deadline_ms") is not None:
+            deadline = time.monotonic() + message["deadline_ms"] / 1000.0
+        return Request(message.get("id"), traj, message.get("dimensions", [640, 480]), pred_length, deadline)
+
+    async def submit(self, message):
+        '''
+        Queue one request and wait for its answer
+        '''
+        self.metrics.counts["requests"] += 1
+        try:
+            request = self.parse_request(message)
+        except (KeyError, TypeError, ValueError) as e:
+            self.metrics.counts["invalid"] += 1
+            return {"id": message.get("id"), "error": "invalid request: {}".format(e)}
+        try:
+            self.queue.put_nowait(request)
+        except asyncio.QueueFull:
+            self.metrics.counts["rejected"] += 1
+            return {"id": request.request_id, "error": "overloaded"}
+        return await request.future
+
+    async def next_batch(self):
+        requests = [await self.queue.get()]
+        window_end = time.monotonic() + self.batch_window
+        while len(requests) < self.max_batch_size:
+            timeout = window_end - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return requests
+
+    def run_batch(self, requests):
+        # runs in an executor thread, requests all have the same shape
+        trajs = np.stack([request.traj for request in requests])
+        grids = np.stack([self.engine.get_grid(request.traj, [request.dimensions] * len(request.traj))
+                          for request in requests])
+        dimensions = [request.dimensions for request in requests]
+        return self.engine.sample_batch(trajs, grids, dimensions, requests[0].pred_length, self.rng)
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self.next_batch()
+            now = time.monotonic()
+            live = []
+            for request in requests:
+                if request.deadline is not None and now > request.deadline:
+                    self.metrics.counts["expired"] += 1
+                    request.future.set_result({"id": request.request_id, "error": "deadline exceeded"})
+                else:
+                    live.append(request)
+
+            # scenes of the same observed and predicted length are run together
+            groups = collections.defaultdict(list)
+            for request in live:
+                groups[(len(request.traj), request.pred_length)].append(request)
+            for group in groups.values():
+                self.metrics.batch_sizes.append(len(group))
+                try:
+                    result = await loop.run_in_executor(None, self.run_batch, group)
+                except Exception as e:
+                    for request in group:
+                        self.metrics.counts["failed"] += 1
+                        request.future.set_result({"id": request.request_id, "error": repr(e)})
+                    continue
+                done = time.monotonic()
+                for request, complete_traj in zip(group, result):
+                    pred = complete_traj[len(request.traj):]
+                    self.metrics.counts["completed"] += 1
+                    self.metrics.latencies.append(done - request.received)
+                    request.future.set_result({"id": request.request_id,
+                                               "pred": [frame[frame[:, 0] != 0].tolist() for frame in pred]})
+
+    async def handle_client(self, reader, writer):
+        pending = set()
+        lock = asyncio.Lock()
+
+        async def answer(message):
+            if message.get("metrics"):
+                response = self.metrics.report(self.queue.qsize())
+                response["id"] = message.get("id")
+            else:
+                response = await self.submit(message)
+            async with lock:
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    message = None
+                if not isinstance(message, dict):
+                    message = {"traj": None}
+                # answered as soon as ready, so one client can have many requests in flight
+                task = asyncio.create_task(answer(message))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=None, host="127.0.0.1", port=8765):
+        batcher = asyncio.create_task(self.batch_loop())
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+        try:
+            await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def predict(scenes, socket_path=None, host="127.0.0.1", port=8765):
+    '''
+    Small blocking client: send a list of requests (see PredictionServer) and return their answers
+    '''
+    if socket_path is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+    else:
+        connection = socket.create_connection((host, port))
+    with connection, connection.makefile("rw") as f:
+        for index, scene in enumerate(scenes):
+            scene = dict(scene)
+            scene.setdefault("id", index)
+            f.write(json.dumps(scene) + "\n")
+        f.flush()
+        answers = {}
+        while len(answers) < len(scenes):
+            answer = json.loads(f.readline())
+            answers[answer["id"]] = answer
+    return [answers[scene.get("id", index)] for index, scene in enumerate(scenes)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", type=str, default=os.path.join(DEFAULT_SAVE_DIR, "social_weights.npz"),
+                        help="npz exported by numpy_model.py")
+    parser.add_argument("--socket", type=str, default=None,
+                        help="unix socket to listen on (default: tcp on --host and --port)")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max_batch_size", type=int, default=32,
+                        help="most scenes run in one rollout")
+    parser.add_argument("--batch_window_ms", type=float, default=5.0,
+                        help="how long to wait for more requests before running a batch")
+    parser.add_argument("--max_queue", type=int, default=256,
+                        help="queued requests before new ones are rejected")
+    args = parser.parse_args()
+
+    engine = NumpySocialLSTM.load(args.weights)
+    server = PredictionServer(engine, args.max_batch_size, args.batch_window_ms / 1000.0, args.max_queue)
+    print("serving on {}".format(args.socket if args.socket is not None else "{}:{}".format(args.host, args.port)))
+    asyncio.run(server.serve(args.socket, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from social_lstm.DataLoader import DataLoader, Recording
+
+
+# memory backed file system, files there are shared memory that every process can map by name
+SHARED_MEMORY_DIR = "/dev/shm"
+
+
+def get_shared_memory_dir():
+    # the temporary directory where there is no /dev/shm, files are still mapped but backed by disk
+    return SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else tempfile.gettempdir()
+
+
+class SharedDataset:
+    '''
+    Publish the frame tensors and window index of a DataLoader in shared memory once, so that other
+    processes map them by name instead of holding their own copy.
+    spec is a small picklable dict to hand to attach() in the worker processes. The publishing process
+    owns the memory and must call close() (or use it as a context manager) when all workers are done.
+    '''
+
+    def __init__(self, data_loader, shared_memory_dir=None):
+        if shared_memory_dir is None:
+            shared_memory_dir = get_shared_memory_dir()
+        self.path = tempfile.mkdtemp(prefix="social_lstm_", dir=shared_memory_dir)
+        self.spec = {"path": self.path,
+                     "seq_length": data_loader.seq_length,
+                     "max_num_peds": data_loader.max_num_peds,
+                     "infer": data_loader.infer,
+                     "weights": list(data_loader.weights),
+                     "recordings": []}
+
+        for index, recording in enumerate(data_loader.recordings):
+            arrays = {}
+            for key, array in (("frame_data", recording.frame_data),
+                               ("training_windows", recording.training_windows),
+                               ("validate_windows", recording.validate_windows)):
+                arrays[key] = self.publish("{}_{}.bin".format(index, key), array)
+            self.spec["recordings"].append({"name": recording.name,
+                                            "dimensions": recording.dimensions,
+                                            "num_training_frames": recording.num_training_frames,
+                                            "num_validate_frames": recording.num_validate_frames,
+                                            "arrays": arrays})
+
+    def publish(self, file_name, array):
+        np.ascontiguousarray(array).tofile(os.path.join(self.path, file_name))
+        return {"name": file_name, "shape": list(array.shape), "dtype": np.dtype(array.dtype).str}
+
+    def close(self):
+        # processes that still map the arrays keep them until they exit
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _read_only_view(path, shape, dtype):
+    if 0 in shape:
+        # nothing to map
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def attach(spec, batch_size):
+    '''
+    Build a DataLoader on read-only views of the shared frame tensors, nothing is copied.
+    Batch pointers are private to the attaching process
+    params:
+    spec : SharedDataset.spec of the publishing process
+    batch_size : batch size of the returned DataLoader, sequences have the published seq_length
+    '''
+    recordings = []
+    for recording_spec in spec["recordings"]:
+        arrays = {}
+        for key, array_spec in recording_spec["arrays"].items():
+            arrays[key] = _read_only_view(os.path.join(spec["path"], array_spec["name"]),
+                                          tuple(array_spec["shape"]), np.dtype(array_spec["dtype"]))
+        recordings.append(Recording.from_arrays(recording_spec["name"],
+                                                recording_spec["dimensions"],
+                                                arrays["frame_data"],
+                                                arrays["training_windows"],
+                                                arrays["validate_windows"],
+                                                spec["seq_length"],
+                                                recording_spec["num_training_frames"],
+                                                recording_spec["num_validate_frames"],
+                                                infer=spec["infer"]))
+
+    return DataLoader(batch_size, spec["seq_length"], spec["max_num_peds"], infer=spec["infer"],
+                      recordings=recordings, weights=spec["weights"])
@@ -1,13 +1,12 @@
 import numpy as np
-import tensorflow as tf
 
 import os
 import pickle
 import argparse
 # import ipdb
 
-from social_lstm.DataLoader import DataLoader
-from social_lstm.model import SocialLSTMModel
+from social_lstm.DataLoader import DataLoader, DEFAULT_SAVE_DIR
+from social_lstm.utils import parse_args_with_config
 from social_lstm.grid import get_sequence_grid_mask, get_sequence_pyramid_mask
 # from social_train import getSocialGrid, getSocialTensor
 
@@ -57,8 +56,58 @@ def get_mean_error(predicted_traj, true_traj, observed_length, maxNumPeds):
     return np.mean(error)
 
 
-def main():
+def evaluate(model, sess, saved_args, sample_args, data_loader, engine=None):
+    '''
+    Sample the predicted part of every validation trajectory and return the mean error and the
+    (true trajectory, complete trajectory, observed length) of each. engine is the NumpySocialLSTM of
+    the weights in sess, read from it once here when not given
+    '''
+    if engine is None:
+        engine = model.get_engine(sess)
+    # Reset all pointers of the data_loader
+    data_loader.reset_batch_pointer(validate=True)
+
+    results = []
+
+    # Variable to maintain total error
+    total_error = 0
+    # For each batch
+    for b in range(data_loader.num_validate_batch): # if validate: line 149 divided by 0 ??
+        # Get the source, target and dataset data for the next batch
+        x, y, d = data_loader.next_validate_batch(random_choose=False)
+
+        # Batch size is 1
+        x_batch, y_batch, d_batch = x[0], y[0], d[0]
+
+        dimensions = data_loader.dimensions[d_batch]
+
+        if saved_args.pyramid == 0:
+            grid_batch = get_sequence_grid_mask(x_batch, dimensions, saved_args.neighborhood_size, saved_args.grid_size)
+        else:
+            grid_batch = get_sequence_pyramid_mask(x_batch)
+
+        obs_traj = x_batch[:sample_args.obs_length]
+        obs_grid = grid_batch[:sample_args.obs_length]
+        # obs_traj is an array of shape obs_length x maxNumPeds x 3
+
+        print("********************** SAMPLING A NEW TRAJECTORY", b, "******************************")
+        complete_traj = model.sample(sess, obs_traj, obs_grid, dimensions, x_batch, sample_args.pred_length,
+                                     engine=engine)
+
+        # ipdb.set_trace()
+        # complete_traj is an array of shape (obs_length+pred_length) x maxNumPeds x 3
+        total_error += get_mean_error(complete_traj, x[0], sample_args.obs_length, saved_args.max_num_peds)
+
+        print("Processed trajectory number : ", b, "out of ", data_loader.num_validate_batch, " trajectories")
+
+        # plot_trajectories(x[0], complete_traj, sample_args.obs_length)
+        # return
+        results.append((x[0], complete_traj, sample_args.obs_length))
+
+    return total_error / data_loader.num_validate_batch, results
 
+
+def main():
     # Set random seed
     np.random.seed(1)
 
@@ -80,82 +129,73 @@ def main():
     parser.add_argument("--pyramid", type=int, default=0,
                         help="whether to use pyramid method")
 
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="json manifest of the recordings to test on (default: the one used in training)")
+
+    parser.add_argument("--save_dir", type=str, default=DEFAULT_SAVE_DIR,
+                        help="directory of the config and checkpoints")
+
+    parser.add_argument("--checkpoints", type=str, nargs="*", default=None,
+                        help="checkpoints to evaluate one after the other (default: the best one in save_dir)")
+
+    parser.add_argument("--config", type=str, default=None,
+                        help="json file of argument defaults, e.g. written by autotune.py")
+    parser.add_argument("--intra_op_threads", type=int, default=0,
+                        help="threads used inside one op (0 lets tensorflow choose)")
+    parser.add_argument("--inter_op_threads", type=int, default=0,
+                        help="ops run in parallel (0 lets tensorflow choose)")
+
     # Parse the parameters
-    sample_args = parser.parse_args()
+    sample_args = parse_args_with_config(parser)
+
+    # tensorflow is only needed from here on, get_mean_error and evaluate work without it
+    import tensorflow as tf
+    from social_lstm.model import ModelCache
 
     # Save directory
-    save_directory = 'save/'
+    save_directory = sample_args.save_dir
 
     # Define the path for the config file for saved args
     with open(os.path.join(save_directory, 'social_config.pkl'), 'rb') as f:
         saved_args = pickle.load(f)
 
-    # Create a SocialModel object with the saved_args and infer set to true
-    if saved_args.pyramid == 0:
-        model = SocialLSTMModel(saved_args, True, pyramid=False)
-    else:
-        model = SocialLSTMModel(saved_args, True, pyramid=True)
-    # Initialize a TensorFlow session
-    sess = tf.InteractiveSession()
-    # Initialize a saver
-    saver = tf.train.Saver()
-
-    # Get the checkpoint state for the model
-    ckpt = tf.train.get_checkpoint_state("./save/")
-    if ckpt and ckpt.model_checkpoint_path:
-        saver.restore(sess, ckpt.model_checkpoint_path)
-
     # Dataset to get data from
     dataset = [sample_args.test_dataset]
 
     # Create a SocialDataLoader object with batch_size 1 and seq_length equal to observed_length + pred_length
-    data_loader = DataLoader(1, sample_args.pred_length + sample_args.obs_length, saved_args.max_num_peds, force_pre_process=True, infer=False)
-
-    # Reset all pointers of the data_loader
-    data_loader.reset_batch_pointer(validate=True)
-
-    results = []
-
-    # Variable to maintain total error
-    total_error = 0
-    # For each batch
-    for b in range(data_loader.num_validate_batch): # if validate: line 149 divided by 0 ??
-        # Get the source, target and dataset data for the next batch
-        x, y = data_loader.next_validate_batch(random_choose=False)
-
-        # Batch size is 1
-        x_batch, y_batch = x[0], y[0]
-
-        dimensions = [640, 480]
-
-        if saved_args.pyramid == 0:
-            grid_batch = get_sequence_grid_mask(x_batch, dimensions, saved_args.neighborhood_size, saved_args.grid_size)
+    manifest = sample_args.manifest if sample_args.manifest is not None else getattr(saved_args, "manifest", None)
+    data_loader = DataLoader(1, sample_args.pred_length + sample_args.obs_length, saved_args.max_num_peds,
+                             infer=False, manifest=manifest)
+
+    # Checkpoints to evaluate, they share one graph
+    checkpoints = sample_args.checkpoints
+    if not checkpoints:
+        ckpt = tf.train.get_checkpoint_state(save_directory)
+        checkpoints = [ckpt.model_checkpoint_path]
+    model_cache = ModelCache(tf.ConfigProto(intra_op_parallelism_threads=sample_args.intra_op_threads,
+                                            inter_op_parallelism_threads=sample_args.inter_op_threads))
+
+    for checkpoint_path in checkpoints:
+        loaded = model_cache.get(saved_args, checkpoint_path)
+        # the same trajectories are sampled for every checkpoint
+        np.random.seed(1)
+        mean_error, results = evaluate(loaded.model, loaded.sess, saved_args, sample_args, data_loader,
+                                       loaded.get_engine())
+
+        # Print the mean error across all the batches
+        print("Total mean error of the model is ", mean_error)
+
+        print("Saving results")
+        if len(checkpoints) == 1:
+            results_path = os.path.join(save_directory, 'social_results.pkl')
         else:
-            grid_batch = get_sequence_pyramid_mask(x_batch)
-
-        obs_traj = x_batch[:sample_args.obs_length]
-        obs_grid = grid_batch[:sample_args.obs_length]
-        # obs_traj is an array of shape obs_length x maxNumPeds x 3
-
-        print("********************** SAMPLING A NEW TRAJECTORY", b, "******************************")
-        complete_traj = model.sample(sess, obs_traj, obs_grid, dimensions, x_batch, sample_args.pred_length)
-
-        # ipdb.set_trace()
-        # complete_traj is an array of shape (obs_length+pred_length) x maxNumPeds x 3
-        total_error += get_mean_error(complete_traj, x[0], sample_args.obs_length, saved_args.max_num_peds)
-
-        print("Processed trajectory number : ", b, "out of ", data_loader.num_validate_batch, " trajectories")
-
-        # plot_trajectories(x[0], complete_traj, sample_args.obs_length)
-        # return
-        results.append((x[0], complete_traj, sample_args.obs_length))
+            results_path = os.path.join(save_directory,
+                                        'social_results_{}.pkl'.format(os.path.basename(checkpoint_path)))
+        with open(results_path, 'wb') as f:
+            pickle.dump(results, f)
 
-    # Print the mean error across all the batches
-    print("Total mean error of the model is ", total_error/data_loader.num_validate_batch)
+    model_cache.close()
 
-    print("Saving results")
-    with open(os.path.join(save_directory, 'social_results.pkl'), 'wb') as f:
-        pickle.dump(results, f)
 
 if __name__ == '__main__':
     main()
@@ -1,11 +1,12 @@
+import os
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # for server running
-import matplotlib.pyplot as plt
 import pickle
+import argparse
 
+from social_lstm.DataLoader import DEFAULT_SAVE_DIR, DEFAULT_PLOT_DIR
 
-def plot_trajectories(true_trajs, pred_trajs, obs_length, name):
+
+def plot_trajectories(true_trajs, pred_trajs, obs_length, name, plot_dir=DEFAULT_PLOT_DIR):
     '''
     Function that plots the true trajectories and the
     trajectories predicted by the model alongside
@@ -15,7 +16,13 @@ def plot_trajectories(true_trajs, pred_trajs, obs_length, name):
     Both parameters are of shape traj_length x maxNumPeds x 3
     obs_length : Length of observed trajectory
     name: Name of the plot
+    plot_dir : directory the plot is saved to
     '''
+    # matplotlib is only loaded when something is drawn
+    import matplotlib
+    matplotlib.use('Agg')  # for server running
+    import matplotlib.pyplot as plt
+
     traj_length, maxNumPeds, _ = true_trajs.shape
 
     # Initialize figure
@@ -73,7 +80,7 @@ def plot_trajectories(true_trajs, pred_trajs, obs_length, name):
     # plt.ylim((0, 1))
     # plt.xlim((0, 1))
     # plt.show()
-    plt.savefig('plot/'+name+'.png')
+    plt.savefig(os.path.join(plot_dir, name + '.png'))
     plt.gcf().clear()
     plt.close()
 
@@ -82,13 +89,22 @@ def main():
     '''
     Main function
     '''
-    f = open('save/social_results.pkl', 'rb')
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--results", type=str, default=os.path.join(DEFAULT_SAVE_DIR, "social_results.pkl"),
+                        help="results written by social_sample.py")
+    parser.add_argument("--plot_dir", type=str, default=DEFAULT_PLOT_DIR,
+                        help="directory to save the plots to")
+    args = parser.parse_args()
+
+    f = open(args.results, 'rb')
     results = pickle.load(f)
 
+    if not os.path.exists(args.plot_dir):
+        os.makedirs(args.plot_dir)
     for i in range(len(results)):
         print(i)
         name = 'sequence' + str(i)
-        plot_trajectories(results[i][0], results[i][1], results[i][2], name)
+        plot_trajectories(results[i][0], results[i][1], results[i][2], name, args.plot_dir)
 
 
 
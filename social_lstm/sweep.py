@@ -0,0 +1,246 @@
+import os
+import csv
+import json
+import time
+import queue
+import argparse
+import itertools
+import contextlib
+import multiprocessing
+
+from social_lstm.DataLoader import DataLoader
+from social_lstm.shared_data import SharedDataset, attach
+from social_lstm.utils import pin_threads, parse_args_with_config
+
+
+def get_configs(grid):
+    '''
+    Expand a sweep grid into a list of configurations
+    params:
+    grid : either a dict of argument name -> list of values (every combination is run),
+           or a list of dicts, one per configuration
+    '''
+    if isinstance(grid, list):
+        return [dict(config) for config in grid]
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def run_name(index, config):
+    return "run{}_".format(index) + "_".join("{}{}".format(name, config[name]) for name in sorted(config))
+
+
+def run_training(index, args, spec, messages, stop):
+    '''
+    Body of one sweep process: train args and report every epoch to the driver
+    '''
+    # pin the thread pools before tensorflow is imported in this process
+    pin_threads(max(args.intra_op_threads, 1))
+    from social_lstm.train import train
+
+    # the driver published the frames of this seq_length and max_num_peds
+    data_loader = attach(spec, args.batch_size)
+
+    def epoch_callback(epoch, train_loss, valid_loss):
+        messages.put(("epoch", index, epoch, train_loss, valid_loss))
+        return stop.is_set()
+
+    try:
+        best_validate_loss, best_epoch = train(args, data_loader=data_loader, epoch_callback=epoch_callback)
+        messages.put(("done", index, best_validate_loss, best_epoch))
+    except Exception as e:
+        messages.put(("failed", index, repr(e), None))
+        raise
+
+
+class Sweep:
+    '''
+    Run many train() configurations at once on the local cores. Every run has its own save_dir
+    under sweep_dir and its own pinned thread pools. The dataset is preprocessed once per seq_length and
+    max_num_peds of the configurations, and the runs read it from shared memory.
+    A run is stopped early (median stopping rule) when, after grace_epochs epochs, its best validation
+    loss is worse than the median of the best validation losses of the other runs at the same epoch.
+    '''
+
+    def __init__(self, base_args, configs, sweep_dir, num_workers, grace_epochs=3):
+        self.base_args = base_args
+        self.configs = configs
+        self.sweep_dir = sweep_dir
+        self.num_workers = num_workers
+        self.grace_epochs = grace_epochs
+        # per run: name, config, state, best validation loss, its epoch, epochs run
+        self.runs = [{"name": run_name(index, config), "config": config, "state": "pending",
+                      "best_validate_loss": None, "best_epoch": None, "epochs": 0}
+                     for index, config in enumerate(configs)]
+        # epoch -> best validation loss until that epoch, of every run, for the stopping rule. Keyed by epoch,
+        # a resumed run reports from the epoch it continues with
+        self.history = [{} for _ in configs]
+
+    def get_run_args(self, index):
+        args = argparse.Namespace(**vars(self.base_args))
+        for name, value in self.configs[index].items():
+            setattr(args, name, value)
+        args.save_dir = os.path.join(self.sweep_dir, self.runs[index]["name"])
+        return args
+
+    def should_stop(self, index, epoch):
+        if epoch + 1 < self.grace_epochs:
+            return False
+        own = self.history[index].get(epoch)
+        if own is None:
+            return False
+        if own != own:
+            # nan
+            return True
+        others = sorted(history[epoch] for i, history in enumerate(self.history)
+                        if i != index and history.get(epoch) is not None)
+        if len(others) == 0:
+            return False
+        median = others[len(others) // 2] if len(others) % 2 else (others[len(others) // 2 - 1] +
+                                                                   others[len(others) // 2]) / 2
+        return own > median
+
+    def run(self):
+        if not os.path.exists(self.sweep_dir):
+            os.makedirs(self.sweep_dir)
+        with open(os.path.join(self.sweep_dir, "configs.json"), "w") as f:
+            json.dump(self.runs, f, indent=2)
+
+        context = multiprocessing.get_context("spawn")
+        messages = context.Queue()
+        stops = [context.Event() for _ in self.configs]
+        processes = {}
+        pending = list(range(len(self.configs)))
+
+        with contextlib.ExitStack() as stack:
+            # preprocess once per sequence shape before any run starts, runs of the same shape attach to the
+            # same frames and none of them writes the recording cache
+            specs = {}
+            for index in range(len(self.configs)):
+                args = self.get_run_args(index)
+                key = (args.seq_length, args.max_num_peds)
+                if key not in specs:
+                    data_loader = DataLoader(args.batch_size, args.seq_length, args.max_num_peds, infer=False,
+                                             manifest=args.manifest)
+                    specs[key] = stack.enter_context(SharedDataset(data_loader)).spec
+
+            while pending or processes:
+                while pending and len(processes) < self.num_workers:
+                    index = pending.pop(0)
+                    args = self.get_run_args(index)
+                    process = context.Process(target=run_training,
+                                              args=(index, args, specs[(args.seq_length, args.max_num_peds)],
+                                                    messages, stops[index]))
+                    process.start()
+                    processes[index] = process
+                    self.runs[index]["state"] = "running"
+                    print("started {}".format(self.runs[index]["name"]))
+
+                try:
+                    message = messages.get(timeout=1.0)
+                except queue.Empty:
+                    message = None
+                if message is not None:
+                    self.handle_message(message, stops)
+
+                for index, process in list(processes.items()):
+                    if not process.is_alive():
+                        process.join()
+                        del processes[index]
+
+            # messages sent right before the last runs exited
+            while True:
+                try:
+                    self.handle_message(messages.get(timeout=1.0), stops)
+                except queue.Empty:
+                    break
+        for run in self.runs:
+            if run["state"] == "running":
+                # exited without reporting
+                run["state"] = "failed"
+
+        self.write_summary()
+        return self.runs
+
+    def handle_message(self, message, stops):
+        kind, index = message[0], message[1]
+        run = self.runs[index]
+        if kind == "epoch":
+            epoch, valid_loss = message[2], message[4]
+            history = self.history[index]
+            run["epochs"] = epoch + 1
+            # best loss of the epochs reported before this one
+            previous = [history[e] for e in history if e < epoch and history[e] is not None]
+            best = min(previous) if previous else None
+            if valid_loss is None:
+                # not validated this epoch, the run is judged on its best loss so far
+                history[epoch] = best
+                return
+            history[epoch] = valid_loss if best is None else min(best, valid_loss)
+            if run["best_validate_loss"] is None or valid_loss < run["best_validate_loss"]:
+                run["best_validate_loss"] = valid_loss
+                run["best_epoch"] = epoch
+            if not stops[index].is_set() and self.should_stop(index, epoch):
+                stops[index].set()
+                run["state"] = "stopped"
+                print("stopping {} after epoch {}".format(run["name"], epoch))
+        elif kind == "done":
+            if run["state"] == "running":
+                run["state"] = "done"
+            print("finished {}, best validation loss {}".format(run["name"], message[2]))
+        elif kind == "failed":
+            run["state"] = "failed"
+            print("{} failed: {}".format(run["name"], message[2]))
+
+    def write_summary(self):
+        runs = sorted(self.runs, key=lambda run: (run["best_validate_loss"] is None,
+                                                  run["best_validate_loss"] or 0))
+        names = sorted(set(name for run in runs for name in run["config"]))
+        header = ["name"] + names + ["state", "epochs", "best_epoch", "best_validate_loss"]
+        rows = [[run["name"]] + [run["config"].get(name, "") for name in names] +
+                [run["state"], run["epochs"], run["best_epoch"], run["best_validate_loss"]] for run in runs]
+
+        with open(os.path.join(self.sweep_dir, "summary.csv"), "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+        widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+        for row in [header] + rows:
+            print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    # imported here, spawned runs import this module again and must pin their threads before tensorflow
+    from social_lstm.train import get_parser
+
+    parser = get_parser()
+    parser.add_argument("--grid", type=str, required=True,
+                        help="json file with argument name -> list of values, or a list of configurations")
+    parser.add_argument("--sweep_dir", type=str, default="./sweep/",
+                        help="every run saves to its own directory in here")
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="runs at the same time (default: cores / threads per run)")
+    parser.add_argument("--threads_per_run", type=int, default=1,
+                        help="tensorflow intra op threads of every run")
+    parser.add_argument("--grace_epochs", type=int, default=3,
+                        help="epochs before a run can be stopped early")
+    args = parse_args_with_config(parser)
+
+    with open(args.grid, "r") as f:
+        configs = get_configs(json.load(f))
+
+    args.intra_op_threads = args.threads_per_run
+    args.inter_op_threads = 1
+    num_workers = args.num_workers
+    if num_workers <= 0:
+        num_workers = max(multiprocessing.cpu_count() // args.threads_per_run, 1)
+
+    start = time.time()
+    sweep = Sweep(args, configs, args.sweep_dir, num_workers, args.grace_epochs)
+    sweep.run()
+    print("sweep of {} runs took {:.1f}s".format(len(configs), time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,22 @@
-import tensorflow as tf
 import argparse
-from social_lstm.DataLoader import DataLoader
-from social_lstm.model import SocialLSTMModel
+from social_lstm.DataLoader import DataLoader, DEFAULT_SAVE_DIR
 import time
 import os
 import pickle
+import queue
+import random
+import threading
+import numpy as np
+import multiprocessing
 from social_lstm.grid import get_sequence_grid_mask, get_sequence_pyramid_mask
+from social_lstm.parallel_train import GradientWorkers
+from social_lstm.utils import parse_args_with_config
 
 
-def main():
+def get_parser():
     parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default=None,
+                        help="json file of argument defaults, e.g. written by autotune.py")
     parser.add_argument("--lstm_num", type=int, default=128,
                         help="size of lstm hidden state")
     parser.add_argument("--batch_size", type=int, default=16)
@@ -34,32 +41,235 @@ def main():
                         help='L2 regularization parameter')
     parser.add_argument("--pyramid", type=int, default=0,
                         help="whether to use pyramid method")
-    args = parser.parse_args()
-    train(args)
+    parser.add_argument("--embedding_rank", type=int, default=0,
+                        help="train the social tensor embedding as two matrices of this rank (0 for one full matrix)")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="json manifest of the recordings to train on (default: data/pixel_pos.csv)")
+    parser.add_argument("--save_dir", type=str, default=DEFAULT_SAVE_DIR,
+                        help="directory of the config and checkpoints")
+    parser.add_argument("--intra_op_threads", type=int, default=0,
+                        help="threads used inside one op (0 lets tensorflow choose)")
+    parser.add_argument("--inter_op_threads", type=int, default=0,
+                        help="ops run in parallel (0 lets tensorflow choose)")
+    parser.add_argument("--validate_every", type=int, default=1,
+                        help="validate and save a checkpoint every this many epochs (and after the last one)")
+    parser.add_argument("--async_validate", type=int, default=0,
+                        help="validate the saved checkpoints in a separate process while training goes on")
+    parser.add_argument("--keep_checkpoints", type=int, default=5,
+                        help="number of checkpoints with the best validation loss kept in save_dir")
+    parser.add_argument("--parallel_workers", type=int, default=0,
+                        help="compute the gradients of every batch in this many processes and apply their average "
+                             "(synchronous data-parallel training, 0 trains sequence by sequence in this process)")
+    parser.add_argument("--threads_per_worker", type=int, default=1,
+                        help="tensorflow intra op threads of every gradient worker")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the window choice and of the initial weights")
+    parser.add_argument("--stateful", type=int, default=0,
+                        help="train on consecutive non-overlapping windows, carrying the LSTM states over "
+                             "(truncated backpropagation through time)")
+    parser.add_argument("--resume", type=int, default=1,
+                        help="continue from the training state in save_dir, at the batch after the last saved one "
+                             "(or from its best checkpoint), 0 starts over from new weights")
+    parser.add_argument("--state_every", type=int, default=100,
+                        help="save the training state every this many batches, besides after every epoch "
+                             "(0 only after every epoch)")
+    return parser
+
+
+def reslot_states(states, old_ped_ids, new_ped_ids):
+    '''
+    Move the final states of the previous window to the slots the same peds have in the next window,
+    new peds start from zero states
+    params:
+    states : MNP x state_size final states of the previous window
+    old_ped_ids, new_ped_ids : ped id of every slot in the previous and the next window, 0 for empty slots
+    '''
+    new_states = np.zeros_like(states)
+    old_slots = {ped_id: slot for slot, ped_id in enumerate(old_ped_ids) if ped_id != 0}
+    for slot, ped_id in enumerate(new_ped_ids):
+        if ped_id in old_slots:
+            new_states[slot] = states[old_slots[ped_id]]
+    return new_states
+
+
+def get_feed(model, args, data_loader, x_batch, y_batch, d_batch):
+    '''
+    Feed of one sequence of a batch: its source and target frames and their grid or pyramid masks
+    '''
+    if args.pyramid == 0:
+        grid_batch = get_sequence_grid_mask(x_batch, data_loader.dimensions[d_batch], args.neighborhood_size,
+                                            args.grid_size)
+    else:
+        grid_batch = get_sequence_pyramid_mask(x_batch)
+    return {model.input_data: x_batch, model.target_data: y_batch, model.grid_data: grid_batch}
+
+
+def validate(sess, model, data_loader, args):
+    '''
+    Mean loss of the validation batches of data_loader
+    '''
+    data_loader.reset_batch_pointer(validate=True)
+    loss_epoch = 0
+
+    for b in range(data_loader.num_validate_batch):
+
+        # Get the source, target and dataset data for the next batch
+        # x, y are input and target data which are lists containing numpy arrays of size seq_length x maxNumPeds x 3
+        x, y, d = data_loader.next_validate_batch()
+
+        # variable to store the loss for this batch
+        loss_batch = 0
+
+        # For each sequence in the batch
+        for batch in range(data_loader.batch_size):
+            feed = get_feed(model, args, data_loader, x[batch], y[batch], d[batch])
+
+            # Feed the source, target data
+            loss_batch += sess.run(model.cost, feed)
+
+        loss_epoch += loss_batch / data_loader.batch_size
+
+    return loss_epoch / data_loader.num_validate_batch
+
+
+def run_validator(args, requests, results):
+    '''
+    Body of the validation process: validate every (epoch, checkpoint path) of requests until None
+    '''
+    import tensorflow as tf
+    from social_lstm.model import SocialLSTMModel
+
+    data_loader = DataLoader(args.batch_size, args.seq_length, args.max_num_peds, infer=False,
+                             manifest=args.manifest)
+    model = SocialLSTMModel(args, pyramid=bool(args.pyramid))
+    # leave the cores to training
+    config = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
+    with tf.Session(config=config) as sess:
+        saver = tf.train.Saver()
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            epoch, checkpoint_path = request
+            saver.restore(sess, checkpoint_path)
+            results.put((epoch, validate(sess, model, data_loader, args)))
+
+
+class Validator:
+    '''
+    Validate checkpoints in a separate process while training goes on. The process reads the recordings
+    of args.manifest itself
+    '''
+
+    def __init__(self, args):
+        context = multiprocessing.get_context("spawn")
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        # checkpoints sent and not answered yet, requests come from the checkpoint writer thread
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.process = context.Process(target=run_validator, args=(args, self.requests, self.results), daemon=True)
+        self.process.start()
+
+    def request(self, epoch, checkpoint_path):
+        with self.lock:
+            self.pending += 1
+        self.requests.put((epoch, checkpoint_path))
+
+    def poll(self, block=False):
+        '''
+        The (epoch, validation loss) results ready so far, with block at least one
+        '''
+        ready = []
+        while self.pending > 0:
+            try:
+                result = self.results.get(block=block and not ready, timeout=1.0)
+            except queue.Empty:
+                if block and not ready and self.process.is_alive():
+                    continue
+                break
+            with self.lock:
+                self.pending -= 1
+            ready.append(result)
+        return ready
+
+    def close(self):
+        '''
+        Wait for the pending results and stop the process
+        '''
+        ready = []
+        while self.pending > 0 and self.process.is_alive():
+            ready += self.poll(block=True)
+        self.requests.put(None)
+        self.process.join()
+        return ready
+
 
+def main():
+    parser = get_parser()
+    args = parse_args_with_config(parser)
+    train(args)
 
-def train(args):
-    data_loader = DataLoader(args.batch_size,
-                             args.seq_length,
-                             args.max_num_peds,
-                             force_pre_process=True,
-                             infer=False)
 
-    with open(os.path.join('./save/', 'social_config.pkl'), 'wb') as f:
+def train(args, data_loader=None, epoch_callback=None):
+    '''
+    Train a model and save it to args.save_dir
+    params:
+    args : parsed arguments of get_parser()
+    data_loader : DataLoader to train on, built from args.manifest if not given
+    epoch_callback : called as epoch_callback(epoch, train_loss, valid_loss) after every epoch,
+                     training stops if it returns True. valid_loss is None when the epoch was not validated
+                     (--validate_every) or its validation is still running (--async_validate)
+    Returns the best validation loss and its epoch
+    '''
+    # tensorflow is imported when training starts, so the parser and the helpers load fast
+    import tensorflow as tf
+    from social_lstm.model import SocialLSTMModel
+    from social_lstm.checkpoint import CheckpointWriter, load_training_state
+
+    if data_loader is None:
+        data_loader = DataLoader(args.batch_size,
+                                 args.seq_length,
+                                 args.max_num_peds,
+                                 infer=False,
+                                 manifest=args.manifest)
+
+    save_dir = getattr(args, "save_dir", DEFAULT_SAVE_DIR)
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    with open(os.path.join(save_dir, 'social_config.pkl'), 'wb') as f:
         pickle.dump(args, f)
 
-    if args.pyramid == 0:
-        model = SocialLSTMModel(args, pyramid=False)
-    else:
-        model = SocialLSTMModel(args, pyramid=True)
-    config = tf.ConfigProto()
+    seed = getattr(args, "seed", None)
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=getattr(args, "intra_op_threads", 0),
+                            inter_op_parallelism_threads=getattr(args, "inter_op_threads", 0))
     config.gpu_options.allow_growth = True
-    with tf.Session() as sess:
+    # a graph of its own, finalized once built
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph, config=config) as sess:
+        if seed is not None:
+            tf.set_random_seed(seed)
+        if args.pyramid == 0:
+            model = SocialLSTMModel(args, pyramid=False)
+        else:
+            model = SocialLSTMModel(args, pyramid=True)
         sess.run(tf.initialize_all_variables())
-        saver = tf.train.Saver(tf.all_variables())
-        ckpt = tf.train.get_checkpoint_state("./save/")
-        if ckpt and ckpt.model_checkpoint_path:
-            saver.restore(sess, ckpt.model_checkpoint_path)
+        saver = tf.train.Saver(tf.global_variables())
+        resume = getattr(args, "resume", 1)
+        training_state = load_training_state(save_dir) if resume else None
+        if training_state is not None:
+            # the optimizer slots and the learning rate come back with the variables
+            saver.restore(sess, training_state["checkpoint_path"])
+            print("resuming from epoch {}, batch {}".format(training_state["epoch"], training_state["batch"]))
+        elif resume:
+            # no training state, start from the best checkpoint of save_dir if there is one
+            ckpt = tf.train.get_checkpoint_state(save_dir)
+            if ckpt and ckpt.model_checkpoint_path:
+                saver.restore(sess, ckpt.model_checkpoint_path)
 
         # get network parameter number
         from functools import reduce
@@ -74,26 +284,126 @@ def train(args):
         print("param count: ", get_num_params())
 
         # Train
-        best_validate_loss = 100
-        best_epoch = 0
+        # best validation loss and its epoch
+        best = [100, 0]
+
+        def update_best(epoch, loss):
+            if loss < best[0]:
+                best[0], best[1] = loss, epoch
+            print('(epoch {}), valid_loss = {:.3f}'.format(epoch, loss))
+
+        if training_state is not None:
+            best[:] = training_state["best"]
+
+        validate_every = max(getattr(args, "validate_every", 1), 1)
+        validate_epochs = set(e for e in range(args.num_epochs)
+                              if (e + 1) % validate_every == 0 or e == args.num_epochs - 1)
+        validator = None
+        if getattr(args, "async_validate", 0):
+            validator = Validator(args)
+        checkpoints, state_checkpoint_path = None, None
+        if training_state is not None:
+            checkpoints, state_checkpoint_path = training_state["checkpoints"], training_state["checkpoint_path"]
+        writer = CheckpointWriter(tf.global_variables(), save_dir, getattr(args, "keep_checkpoints", 5),
+                                  on_saved=validator.request if validator is not None else None,
+                                  checkpoints=checkpoints, state_checkpoint_path=state_checkpoint_path)
+        if validator is not None:
+            # checkpoints of the previous run whose validation did not finish
+            for step, (checkpoint_path, loss) in sorted(writer.checkpoints.items()):
+                if loss is None:
+                    validator.request(step, checkpoint_path)
+
+        workers = None
+        if getattr(args, "parallel_workers", 0) > 0:
+            if getattr(args, "stateful", 0):
+                raise ValueError("--stateful is not supported with --parallel_workers")
+            workers = GradientWorkers(args, data_loader, tf.trainable_variables(), args.parallel_workers)
+            if training_state is not None and training_state["workers"] is not None:
+                workers.set_state(training_state["workers"])
+
+        # nothing is added to the graph from here on
+        graph.finalize()
+
+        stateful = getattr(args, "stateful", 0)
+        if stateful:
+            # one epoch walks the planned training windows once, in order
+            num_training_batch = data_loader.num_stateful_batch
+            # (final states, ped ids) of the last window of every sequence of the batch
+            carried_states = [None] * data_loader.batch_size
+        else:
+            num_training_batch = data_loader.num_training_batch
+
+        def save_state(epoch, batch, loss_epoch, values=None):
+            '''
+            Queue what is needed to continue exactly with batch of epoch to the writer, values is a snapshot
+            of the variables already taken at this point
+            '''
+            step = epoch * num_training_batch + batch
+            state = {"epoch": epoch,
+                     "batch": batch,
+                     "step": step,
+                     "loss_epoch": loss_epoch,
+                     "best": list(best),
+                     "random": random.getstate(),
+                     "numpy_random": np.random.get_state(),
+                     "loader": data_loader.get_state(),
+                     "carried_states": list(carried_states) if stateful else None,
+                     "workers": workers.get_state() if workers is not None else None}
+            if values is None:
+                values = writer.snapshot(sess)
+            writer.save_state(values, state, step)
+
+        start_epoch, start_batch = 0, 0
+        if training_state is not None:
+            start_epoch, start_batch = training_state["epoch"], training_state["batch"]
+            random.setstate(training_state["random"])
+            np.random.set_state(training_state["numpy_random"])
+            data_loader.set_state(training_state["loader"])
+            if stateful and training_state["carried_states"] is not None:
+                carried_states = training_state["carried_states"]
+        state_every = getattr(args, "state_every", 100)
 
         # For each epoch
-        for e in range(args.num_epochs):
+        for e in range(start_epoch, args.num_epochs):
             # Assign the learning rate value for this epoch
-            sess.run(tf.assign(model.lr, args.learning_rate * (args.decay_rate ** e)))
-            # Reset the data pointers in the data_loader
-            data_loader.reset_batch_pointer(validate=False)
-
-            loss_epoch = 0
+            sess.run(model.lr_update, {model.lr_value: args.learning_rate * (args.decay_rate ** e)})
+
+            if e == start_epoch and start_batch > 0:
+                # resumed in the middle of the epoch, the loader continues where it was
+                first_batch = start_batch
+                loss_epoch = training_state["loss_epoch"]
+            else:
+                # Reset the data pointers in the data_loader
+                data_loader.reset_batch_pointer(validate=False)
+                if stateful:
+                    # every sequence starts its segment of the training frames again
+                    data_loader.reset_stateful_streams()
+                first_batch = 0
+                loss_epoch = 0
 
             # For each batch
-            for b in range(data_loader.num_training_batch):
+            for b in range(first_batch, num_training_batch):
+                if state_every > 0 and b > first_batch and b % state_every == 0:
+                    save_state(e, b, loss_epoch)
+
                 # Tic
                 start = time.time()
 
+                if workers is not None:
+                    # the whole batch is one synchronous step of the workers
+                    loss_batch = workers.step(sess, model)
+                    loss_epoch += loss_batch
+                    print("{}/{} (epoch {}), train_loss = {:.3f}, time/batch = {:.3f}".format(
+                        e * num_training_batch + b, args.num_epochs * num_training_batch, e, loss_batch,
+                        time.time() - start))
+                    continue
+
                 # Get the source, target and dataset data for the next batch x, y are input and target data which are
                 # lists containing numpy arrays of size seq_length x maxNumPeds x 3
-                x, y = data_loader.next_training_batch()
+                if stateful:
+                    x, y, d, ped_ids, reset = data_loader.next_stateful_batch()
+                else:
+                    x, y, d = data_loader.next_training_batch()
 
                 # variable to store the loss for this batch
                 loss_batch = 0
@@ -104,19 +414,18 @@ def train(args):
                     # seq_length long consecutive frames in the dataset
                     # x_batch, y_batch would be numpy arrays of size seq_length x maxNumPeds x 3
                     # d_batch would be a scalar identifying the dataset from which this sequence is extracted
-                    x_batch, y_batch = x[batch], y[batch]
-
-                    dataset_data = [640, 480]
-
-                    if args.pyramid == 0:
-                        grid_batch = get_sequence_grid_mask(x_batch, dataset_data, args.neighborhood_size, args.grid_size)
-                        feed = {model.input_data: x_batch, model.target_data: y_batch, model.grid_data: grid_batch}
+                    feed = get_feed(model, args, data_loader, x[batch], y[batch], d[batch])
+
+                    if stateful:
+                        # the carried states are fed as constants, so gradients stop at the window boundary
+                        if not reset[batch] and carried_states[batch] is not None:
+                            final_states, old_ped_ids = carried_states[batch]
+                            feed[model.LSTM_states] = reslot_states(final_states, old_ped_ids, ped_ids[batch])
+                        train_loss, _, final_states = sess.run([model.cost, model.train_op, model.final_states], feed)
+                        carried_states[batch] = (final_states, ped_ids[batch])
                     else:
-                        pyramid_batch = get_sequence_pyramid_mask(x_batch)
-                        feed = {model.input_data: x_batch, model.target_data: y_batch, model.grid_data: pyramid_batch}
-
-                    # Feed the source, target data
-                    train_loss, _, = sess.run([model.cost, model.train_op], feed)
+                        # Feed the source, target data
+                        train_loss, _, = sess.run([model.cost, model.train_op], feed)
 
                     # train_loss, _, o_mux, o_muy, o_sx, o_sy, o_corr = \
                     #     sess.run([model.cost, model.train_op, model.o_mux, model.o_muy, model.o_sx, model.o_sy, model.o_corr], feed)
@@ -132,65 +441,53 @@ def train(args):
                 loss_epoch += loss_batch
                 print(
                     "{}/{} (epoch {}), train_loss = {:.3f}, time/batch = {:.3f}".format(
-                        e * data_loader.num_training_batch + b,
-                        args.num_epochs * data_loader.num_training_batch,
+                        e * num_training_batch + b,
+                        args.num_epochs * num_training_batch,
                         e,
                         loss_batch, end - start))
 
-            loss_epoch /= data_loader.num_training_batch
+            loss_epoch /= num_training_batch
+            train_loss_epoch = loss_epoch
 
             # Validation
-            data_loader.reset_batch_pointer(validate=True)
-            loss_epoch = 0
-
-            for b in range(data_loader.num_validate_batch):
-
-                # Get the source, target and dataset data for the next batch
-                # x, y are input and target data which are lists containing numpy arrays of size seq_length x maxNumPeds x 3
-                x, y = data_loader.next_validate_batch()
-
-                # variable to store the loss for this batch
-                loss_batch = 0
-
-                # For each sequence in the batch
-                for batch in range(data_loader.batch_size):
-                    # x_batch, y_batch and d_batch contains the source, target and dataset index data for
-                    # seq_length long consecutive frames in the dataset
-                    # x_batch, y_batch would be numpy arrays of size seq_length x maxNumPeds x 3
-                    # d_batch would be a scalar identifying the dataset from which this sequence is extracted
-                    x_batch, y_batch = x[batch], y[batch]
-
-                    dataset_data = [640, 480]
-
-                    if args.pyramid == 0:
-                        grid_batch = get_sequence_grid_mask(x_batch, dataset_data, args.neighborhood_size, args.grid_size)
-                        feed = {model.input_data: x_batch, model.target_data: y_batch, model.grid_data: grid_batch}
-                    else:
-                        pyramid_batch = get_sequence_pyramid_mask(x_batch)
-                        feed = {model.input_data: x_batch, model.target_data: y_batch, model.grid_data: pyramid_batch}
-
-                    # Feed the source, target data
-                    train_loss = sess.run(model.cost, feed)
-
-                    loss_batch += train_loss
-
-                loss_batch = loss_batch / data_loader.batch_size
-                loss_epoch += loss_batch
-
-            loss_epoch /= data_loader.num_validate_batch
-
-            # Update best validation loss until now
-            if loss_epoch < best_validate_loss:
-                best_validate_loss = loss_epoch
-                best_epoch = e
-
-                # Save the model after each epoch
-                checkpoint_path = os.path.join("save/", 'social_model.ckpt')
-                saver.save(sess, checkpoint_path, global_step=e)
-                print("model saved to {}".format(checkpoint_path))
-
-            print('(epoch {}), valid_loss = {:.3f}'.format(e, loss_epoch))
-            print('Best epoch', best_epoch, 'Best validation loss', best_validate_loss)
+            valid_loss = None
+            # the checkpoint and the training state of the epoch share one snapshot
+            values = None
+            if e in validate_epochs:
+                values = writer.snapshot(sess)
+                if validator is not None:
+                    # saved right away, the validator process picks the checkpoint up once it is written
+                    writer.save(values, e)
+                else:
+                    valid_loss = validate(sess, model, data_loader, args)
+                    writer.save(values, e, valid_loss)
+                    update_best(e, valid_loss)
+            if validator is not None:
+                for epoch, loss in validator.poll():
+                    writer.set_loss(epoch, loss)
+                    update_best(epoch, loss)
+                    if epoch == e:
+                        valid_loss = loss
+
+            print('Best epoch', best[1], 'Best validation loss', best[0])
+            save_state(e + 1, 0, 0, values)
+
+            if epoch_callback is not None and epoch_callback(e, train_loss_epoch, valid_loss):
+                print("training stopped after epoch {}".format(e))
+                break
+
+        if workers is not None:
+            workers.close()
+        writer.flush()
+        if validator is not None:
+            # losses of the last checkpoints
+            for epoch, loss in validator.close():
+                writer.set_loss(epoch, loss)
+                update_best(epoch, loss)
+            print('Best epoch', best[1], 'Best validation loss', best[0])
+        writer.close()
+
+    return best[0], best[1]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import os
+import json
+import argparse
+import numpy as np
+
+
+def percentiles(times):
+    '''
+    Summary of a list of durations in seconds, in milliseconds
+    '''
+    times = np.asarray(times) * 1000
+    return {"mean": float(np.mean(times)),
+            "p50": float(np.percentile(times, 50)),
+            "p90": float(np.percentile(times, 90)),
+            "p99": float(np.percentile(times, 99))}
+
+
+def pin_threads(threads):
+    '''
+    Limit the OpenMP and MKL thread pools of this process, must run before tensorflow is imported
+    '''
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+
+
+def parse_args_with_config(parser, argv=None):
+    '''
+    Parse the arguments of parser, with a --config json file (e.g. written by autotune.py) providing the defaults.
+    Arguments given on the command line override the config, keys the parser does not know are ignored
+    '''
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument("--config", type=str, default=None)
+    known, _ = config_parser.parse_known_args(argv)
+    if known.config is not None:
+        with open(known.config) as f:
+            config = json.load(f)
+        names = {action.dest for action in parser._actions}
+        parser.set_defaults(**{key: value for key, value in config.items() if key in names})
+    return parser.parse_args(argv)